@@ -1,34 +1,37 @@
 """Monitors backlight brightness from collectd."""
 
 import os
-import sys
-import traceback
 
 import collectd
 
 _SYSFS_BL_DIR = '/sys/class/backlight/'
 
+_VALUES = collectd.Values(type='percent', plugin='backlight')
+
 
 def read(_=None):
-    values = collectd.Values(type='percent', plugin='backlight')
+    values = _VALUES
 
     for backlight in os.listdir(_SYSFS_BL_DIR):
         try:
             # "brightness" may differ from "actual_brightness" especially when lid is closed.
-            with open(_SYSFS_BL_DIR + backlight +
-                      '/actual_brightness') as sysfs_value:
-                bl_now = float(sysfs_value.read())
-            with open(_SYSFS_BL_DIR + backlight +
-                      '/max_brightness') as sysfs_value:
-                bl_max = float(sysfs_value.read())
+            # sysfs attributes are small, so skip the buffered text file machinery
+            fd = os.open(_SYSFS_BL_DIR + backlight + '/actual_brightness', os.O_RDONLY)
+            try:
+                bl_now = float(os.read(fd, 32))
+            finally:
+                os.close(fd)
+            fd = os.open(_SYSFS_BL_DIR + backlight + '/max_brightness', os.O_RDONLY)
+            try:
+                bl_max = float(os.read(fd, 32))
+            finally:
+                os.close(fd)
             values.dispatch(type_instance=backlight,
                             values=[bl_now / bl_max * 100])
-        except OSError:
-            exc_type, exc_value, exc_traceback = sys.exc_info()
-            collectd.warning(
-                repr(
-                    traceback.format_exception(exc_type, exc_value,
-                                               exc_traceback)))
+        except OSError as err:
+            # The error already names the sysfs file, no need for a traceback
+            collectd.warning('Failed to read backlight {}: {}'.format(
+                backlight, err))
 
 
 collectd.register_read(read)
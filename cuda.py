@@ -10,6 +10,11 @@ import xml.etree.ElementTree as ET
 
 import collectd
 
+# nvidia-smi may hang along with the driver, which must not block collectd's read thread
+_TIMEOUT = 5
+
+_VALUES = collectd.Values(plugin='cuda')
+
 
 def dispatch(values, tree, path, type, instance=None, multiplier=1.):
     """Dispatches normal values (organized by card)."""
@@ -66,7 +71,7 @@ def dispatch_proc_stat(values, tree):
                         values=[proc_mem])
     except (ValueError, AttributeError) as err:
         # Ignore exceptions since values may not be available on all platforms
-        collectd.debug(path + ': ' + str(err))
+        collectd.debug('processes: ' + str(err))
 
 
 _PROPERTIES = [
@@ -126,10 +131,16 @@ _PROPERTIES_STATE = [
 
 
 def read(_=None):
-    values = collectd.Values(plugin='cuda')
+    values = _VALUES
 
-    out = subprocess.Popen(['nvidia-smi', '-q', '-x'],
-                           stdout=subprocess.PIPE).communicate()[0]
+    try:
+        out = subprocess.run(['nvidia-smi', '-q', '-x'],
+                             stdout=subprocess.PIPE,
+                             check=False,
+                             timeout=_TIMEOUT).stdout
+    except subprocess.TimeoutExpired:
+        collectd.warning('Timed out waiting for nvidia-smi')
+        return
     try:
         root = ET.fromstring(out)
     except ET.ParseError as err:
@@ -5,11 +5,100 @@ WARNING: DANGER: intel-gpu-tools may irreversibly hang your integrated graphics!
 (i915 reset won't be able to recorver)
 """
 
-import re
+import os
 import subprocess
 
 import collectd
 
+# intel_gpu_top is kept running and sampled on every read, rather than started for each read
+_SAMPLE_PERIOD_MS = 1000
+
+# Timeout for one-off commands, since a hung GPU must not block collectd's read thread
+_TIMEOUT = 5
+
+_VALUES = collectd.Values(plugin='igfx')
+
+_N_COLUMNS = 18
+
+# Each row = (column, type, instance). Disabled columns are commented out.
+_COLUMNS = (
+    (1, 'percent', 'render'),
+    #(2, 'operations_per_second', 'render'),
+    (3, 'percent', 'bitstream0'),
+    #(4, 'operations_per_second', 'bitstream0'),
+    (5, 'percent', 'bitstream1'),
+    #(6, 'operations_per_second', 'bitstream1'),
+    (7, 'percent', 'blitter'),
+    #(8, 'operations_per_second', 'blitter'),
+    #(9, 'operations_per_second', 'vertices_fetch'),
+    #(10, 'operations_per_second', 'primitives_fetch'),
+    #(11, 'operations_per_second', 'vertex_shader'),
+    #(12, 'operations_per_second', 'geometry_shader'),
+    #(13, 'count', 'geometry_shader_primitives'),
+    #(14, 'operations_per_second', 'clipper'),
+    #(15, 'count', 'clipper_primitives'),
+    #(16, 'operations_per_second', 'pixel_shader'),
+    #(17, 'count', 'pixel_shader_depth_pass'),
+)
+
+# NOTE: intel_gpu_top has integer overflow for the counters from this column onwards
+_FIRST_OVERFLOWING_COLUMN = 9
+_OVERFLOW = 1 << 63
+
+_proc = None
+_buf = b''
+
+
+def _start():
+    global _proc, _buf
+    try:
+        _proc = subprocess.Popen(
+            ['intel_gpu_top', '-s', str(_SAMPLE_PERIOD_MS), '-o', '-'],
+            stdout=subprocess.PIPE, bufsize=0)
+    except OSError as err:
+        # Tried again on the next read
+        collectd.error(f'Failed to start intel_gpu_top: {err}')
+        _proc = None
+        return
+    os.set_blocking(_proc.stdout.fileno(), False)
+    _buf = b''
+
+
+def _read_last_sample():
+    """Returns the columns of the most recent sample from intel_gpu_top, or None if none yet."""
+    global _buf
+    if _proc is None:
+        _start()
+        return None
+    if _proc.poll() is not None:
+        collectd.warning(f'intel_gpu_top exited with {_proc.returncode}, restarting')
+        _start()
+        return None
+    # Drain everything written since the last read, only the newest sample is of interest
+    while True:
+        chunk = _proc.stdout.read(65536)
+        if not chunk:
+            break
+        _buf += chunk
+    lines = _buf.split(b'\n')
+    # The last element is an incomplete line (or empty), keep it for the next read
+    _buf = lines.pop()
+    for line in reversed(lines):
+        # Skip (periodically repeated) headers without splitting them
+        if line and not line.startswith(b'#'):
+            return line.split()
+    return None
+
+
+def init():
+    _start()
+
+
+def shutdown():
+    if _proc is not None:
+        _proc.terminate()
+        _proc.wait()
+
 
 # "intel_perf_counters" (too detailed? Also not working on kabylake-r or newer. Not implemented now)
 # "intel_gpu_top -s 100 -o -"
@@ -19,132 +108,42 @@ import collectd
 # NOTE: On newer kernels this may need modifying the kernel.perf_event_paranoid sysctl setting.
 #       See: https://unix.stackexchange.com/a/14256/177804
 def read(_=None):
-    values = collectd.Values(plugin='igfx')
-
-    out = subprocess.Popen(['intel_gpu_frequency', '-g'],
-                           stdout=subprocess.PIPE).communicate()[0]
+    values = _VALUES
+
+    try:
+        out = subprocess.run(['intel_gpu_frequency', '-g'],
+                             stdout=subprocess.PIPE,
+                             check=False,
+                             timeout=_TIMEOUT).stdout
+    except subprocess.TimeoutExpired:
+        collectd.warning('Timed out waiting for intel_gpu_frequency')
+        out = b''
     for line in out.split(b'\n'):
-        if "cur" in line:
+        if b"cur" in line:
             values.dispatch(type='frequency',
                             type_instance='gpu',
                             values=[1e6 * float(line.split()[1])])
 
-    proc = subprocess.Popen(['intel_gpu_top', '-s', '100', '-o', '-'],
-                            stdout=subprocess.PIPE)
-    col = []
-    proc.stdout.readline()
-    col = re.sub(' +', ' ', proc.stdout.readline()).split()
-    proc.terminate()
-    if col[0] == '#' or col[0] == '' or len(col) != 18:
+    # NOTE: columns are kept as bytes, which float() accepts
+    col = _read_last_sample()
+    if col is None:
+        return
+    if len(col) != _N_COLUMNS:
         collectd.error(f'Wrong number of columns: {col}')
         return
 
     # Unavailable statistics are marked with -1.
     # col[0] is timestamp, we can ignore it.
-
-    # col[1] is render busy %
-    n = float(col[1])
-    if n >= 0:
-        values.dispatch(type='percent', type_instance='render', values=[n])
-
-    # col[2] is render ops
-    #n = float(col[2])
-    #if n >= 0:
-    #  values.dispatch(type = 'operations_per_second', type_instance = 'render', values = [n])
-
-    # col[3] is bitstream 0 busy %
-    n = float(col[3])
-    if n >= 0:
-        values.dispatch(type='percent', type_instance='bitstream0', values=[n])
-
-    # col[4] is bitstream 0 ops
-    #n = float(col[4])
-    #if n >= 0:
-    #  values.dispatch(type = 'operations_per_second', type_instance = 'bitstream0', values = [n])
-
-    # col[5] is bitstream 1 busy %
-    n = float(col[5])
-    if n >= 0:
-        values.dispatch(type='percent', type_instance='bitstream1', values=[n])
-
-    # col[6] is bitstream 1 ops
-    #n = float(col[6])
-    #if n >= 0:
-    #  values.dispatch(type = 'operations_per_second', type_instance = 'bitstream1', values = [n])
-
-    # col[7] is blitter busy %
-    n = float(col[7])
-    if n >= 0:
-        values.dispatch(type='percent', type_instance='blitter', values=[n])
-
-    # col[8] is blitter ops
-    #n = float(col[8])
-    #if n >= 0:
-    #  values.dispatch(type = 'operations_per_second', type_instance = 'blitter', values = [n])
-
-    # NOTE: intel_gpu_top has integer overflow for the following fields:
-    # col[9] is vertices fetch
-    #n = float(col[9])
-    #if n >= 0:
-    #  if n > pow(2, 63):
-    #    n = 0
-    #  values.dispatch(type = 'operations_per_second', type_instance = 'vertices_fetch', values = [n])
-
-    # col[10] is primitives fetch
-    #n = float(col[10])
-    #if n >= 0:
-    #  if n > pow(2, 63):
-    #    n = 0
-    #  values.dispatch(type = 'operations_per_second', type_instance = 'primitives_fetch', values = [n])
-
-    # col[11] is vertex shader invocations
-    #n = float(col[11])
-    #if n >= 0:
-    #  if n > pow(2, 63):
-    #    n = 0
-    #  values.dispatch(type = 'operations_per_second', type_instance = 'vertex_shader', values = [n])
-
-    # col[12] is geometry shader invocations
-    #n = float(col[12])
-    #if n >= 0:
-    #  if n > pow(2, 63):
-    #    n = 0
-    #  values.dispatch(type = 'operations_per_second', type_instance = 'geometry_shader', values = [n])
-
-    # col[13] is geometry shader primitives
-    #n = float(col[13])
-    #if n >= 0:
-    #  if n > pow(2, 63):
-    #    n = 0
-    #  values.dispatch(type = 'count', type_instance = 'geometry_shader_primitives', values = [n])
-
-    # col[14] is clipper invocations
-    #n = float(col[14])
-    #if n >= 0:
-    #  if n > pow(2, 63):
-    #    n = 0
-    #  values.dispatch(type = 'operations_per_second', type_instance = 'clipper', values = [n])
-
-    # col[15] is clipper primitives
-    #n = float(col[15])
-    #if n >= 0:
-    #  if n > pow(2, 63):
-    #    n = 0
-    #  values.dispatch(type = 'count', type_instance = 'clipper_primitives', values = [n])
-
-    # col[16] is pixel shader invocations
-    #n = float(col[16])
-    #if n >= 0:
-    #  if n > pow(2, 63):
-    #    n = 0
-    #  values.dispatch(type = 'operations_per_second', type_instance = 'pixel_shader', values = [n])
-
-    # col[17] is pixel shader depth passes
-    #n = float(col[17])
-    #if n >= 0:
-    #  if n > pow(2, 63):
-    #    n = 0
-    #  values.dispatch(type = 'count', type_instance = 'pixel_shader_depth_pass', values = [n])
+    dispatch = values.dispatch
+    for i, type_, instance in _COLUMNS:
+        n = float(col[i])
+        if n < 0:
+            continue
+        if i >= _FIRST_OVERFLOWING_COLUMN and n > _OVERFLOW:
+            n = 0
+        dispatch(type=type_, type_instance=instance, values=[n])
 
 
+collectd.register_init(init)
 collectd.register_read(read)
+collectd.register_shutdown(shutdown)
@@ -1,7 +1,6 @@
 import time
 
-from envsensor._smbus2 import SMBus
-from envsensor._utils import get_i2c_bus_number, uw_cm2_to_w_m2, get_word_le, get_24bit_le
+from envsensor._utils import get_i2c_bus, uw_cm2_to_w_m2, get_word_le, get_24bit_le
 
 def _gain_table_from_product(agains, itimes):
   # The comprehension should not be inlined in the beginning of the class, since they cannot access
@@ -163,7 +162,7 @@ class APDS_9250:
   }]
 
   def __init__(self, bus, address = I2C_ADDR):
-    self.bus = SMBus(get_i2c_bus_number(bus))
+    self.bus = get_i2c_bus(bus)
     self.address = address
 
     # Verify chip ID
@@ -181,6 +180,7 @@ class APDS_9250:
     self.bus.write_byte_data(
         self.address, self.REG_MAIN_CTRL, self.MAIN_CTRL_CS_EN | self.MAIN_CTRL_LS_EN)
     time.sleep(0.01)
+    self.again = None # Not programmed yet
 
   def get_channel_modes(self):
     return self.channel_modes
@@ -197,8 +197,10 @@ class APDS_9250:
     if itime != self.INT_TIME:
       raise ValueError('Invalid integration time (can only be {}): {}'.format(self.INT_TIME, itime))
 
-    self.again = again
-    self.bus.write_byte_data(self.address, self.REG_LS_GAIN, self.again_table[again])
+    # The estimation pass often selects the gain already programmed, so skip the write then
+    if again != self.again:
+      self.bus.write_byte_data(self.address, self.REG_LS_GAIN, self.again_table[again])
+      self.again = again
 
   def read_channels(self):
     # Invalidate old data
@@ -230,13 +232,14 @@ class APDS_9250:
     sat_g = (g_count + 1) / max_count
     sat_b = (b_count + 1) / max_count
     sat_ir = (ir_count + 1) / max_count
-    sat_p = max([sat_r, sat_g, sat_b, sat_ir])
+    sat_p = max(sat_r, sat_g, sat_b, sat_ir)
 
     # Compute radiometric channels
-    r = r_count * self.R_TO_IRRADIANCE / self.again
-    g = g_count * self.G_TO_IRRADIANCE / self.again
-    b = b_count * self.B_TO_IRRADIANCE / self.again
-    ir = ir_count * self.IR_TO_IRRADIANCE / self.again
+    inv_again = 1. / self.again
+    r = r_count * self.R_TO_IRRADIANCE * inv_again
+    g = g_count * self.G_TO_IRRADIANCE * inv_again
+    b = b_count * self.B_TO_IRRADIANCE * inv_again
+    ir = ir_count * self.IR_TO_IRRADIANCE * inv_again
 
     ppfd = (
         r * self.R_IRRADIANCE_TO_PPFD
@@ -417,7 +420,7 @@ class TSL2591:
   IRRADIANCE_TO_PPFD  = 5.02 * 1.00 # Dominate @ 600 nm, 1 W/m2 ~ 5.02 umol/m2s, RQE ~ 1.00
 
   def __init__(self, bus, address = I2C_ADDR):
-    self.bus = SMBus(get_i2c_bus_number(bus))
+    self.bus = get_i2c_bus(bus)
     self.address = address
 
     # Verify chip ID
@@ -453,10 +456,12 @@ class TSL2591:
           + ', possible values: '
           + str(self.itime_table.keys()))
 
-    self.bus.write_byte_data(
-        self.address,
-        self.CMD_NORMAL | self.REG_CONFIG,
-        self.again_reg_table[again] | self.itime_table[itime][0])
+    # The estimation pass often selects the mode already programmed, so skip the write then
+    if again != self.again or itime != self.itime:
+      self.bus.write_byte_data(
+          self.address,
+          self.CMD_NORMAL | self.REG_CONFIG,
+          self.again_reg_table[again] | self.itime_table[itime][0])
     self.again = again
     self.itime = itime
     self.multiplier = round(again * itime / min(self.itime_table.keys()))
@@ -472,8 +477,13 @@ class TSL2591:
     if not status & self.STATUS_AVALID:
       raise TimeoutError('Sensor measurement timeout')
 
-    clear = self.bus.read_word_data(self.address, self.CMD_NORMAL | self.REG_C0DATAL)
-    ir = self.bus.read_word_data(self.address, self.CMD_NORMAL | self.REG_C1DATAL)
+    # Read both channels in one transaction. The command register auto-increments, and reading
+    # C0DATAL latches the other 3 bytes, so both channels come from the same integration cycle.
+    base = self.REG_C0DATAL
+    length = self.REG_C1DATAH - self.REG_C0DATAL + 1
+    data = self.bus.read_i2c_block_data(self.address, self.CMD_NORMAL | base, length)
+    clear = get_word_le(data, self.REG_C0DATAL, base)
+    ir = get_word_le(data, self.REG_C1DATAL, base)
     self.bus.write_byte_data(
         self.address, self.CMD_NORMAL | self.REG_ENABLE, self.ENABLE_PON)
 
@@ -484,7 +494,7 @@ class TSL2591:
     max_count = (1 << 16) - 1
     sat_clear = (clear + 1) / max_count
     sat_ir    = (ir + 1) / max_count
-    sat_perceptive = max([sat_clear, sat_ir])
+    sat_perceptive = max(sat_clear, sat_ir)
 
     '''
     ADC count per Lux: cpl = (ATIME * AGAIN) / DF
@@ -504,10 +514,11 @@ class TSL2591:
     Alternative 2:
     lux = (clear - LUX_COEFB * ir) / cpl
     '''
-    lux = (clear - self.LUX_COEFB * ir) / (self.multiplier * 100 / self.LUX_DF)
+    inv_multiplier = 1. / self.multiplier
+    lux = (clear - self.LUX_COEFB * ir) * (self.LUX_DF / 100) * inv_multiplier
 
-    irradiance_clear = self.CLEAR_TO_IRRADIANCE * clear / self.multiplier
-    irradiance_ir = self.IR_TO_IRRADIANCE * ir / self.multiplier
+    irradiance_clear = self.CLEAR_TO_IRRADIANCE * clear * inv_multiplier
+    irradiance_ir = self.IR_TO_IRRADIANCE * ir * inv_multiplier
     ppfd = self.IRRADIANCE_TO_PPFD * (
         irradiance_clear * self.CLEAR_PPFD_COEF + irradiance_ir * self.IR_PPFD_COEF)
 
@@ -624,7 +635,7 @@ class VEML6075:
   }]
 
   def __init__(self, bus, address = I2C_ADDR):
-    self.bus = SMBus(get_i2c_bus_number(bus))
+    self.bus = get_i2c_bus(bus)
     self.address = address
 
     # Verify chip ID
@@ -633,10 +644,11 @@ class VEML6075:
       raise IOError('Invalid device ID (0x{:04x})'.format(device_id))
 
     # Power cycle and set single measurement mode
+    # NOTE: no delay is needed after powering on, since nothing is measured until triggered and the
+    # wait in read_channels() has plenty of margin
     self.bus.write_word_data(self.address, self.CMD_UV_CONF, self.UV_CONF_SD)
     time.sleep(0.01)
     self.bus.write_word_data(self.address, self.CMD_UV_CONF, self.UV_CONF_AF)
-    time.sleep(0.01)
     self.uvconf = None
 
   def get_channel_modes(self):
@@ -656,6 +668,9 @@ class VEML6075:
 
     self.itime = itime
     self.uvconf = self.itime_table[itime] | self.UV_CONF_AF
+    # Responsivity only depends on integration time, so compute it here rather than on every read
+    self.response_uva = self.UVA_TO_IRRADIANCE / (itime / self.min_itime)
+    self.response_uvb = self.UVB_TO_IRRADIANCE / (itime / self.min_itime)
 
   def read_channels(self):
     if self.uvconf == None:
@@ -677,14 +692,11 @@ class VEML6075:
     uvcomp1 = self.bus.read_word_data(self.address, self.CMD_UVCOMP1_DATA)
     uvcomp2 = self.bus.read_word_data(self.address, self.CMD_UVCOMP2_DATA)
 
-    # Compute saturation values
-    uva_sat = (uva + 1) / (1 << 16)
-    uvb_sat = (uvb + 1) / (1 << 16)
-    uvd_sat = (uvd + 1) / (1 << 16)
-    uvcomp1_sat = (uvcomp1 + 1) / (1 << 16)
-    uvcomp2_sat = (uvcomp2 + 1) / (1 << 16)
-    uva_sat = max([uva_sat, uvd_sat, uvcomp1_sat, uvcomp2_sat])
-    uvb_sat = max([uvb_sat, uvd_sat, uvcomp1_sat, uvcomp2_sat])
+    # Compute saturation values, taking the highest count among the channel and the channels it is
+    # compensated with
+    comp_max = max(uvd, uvcomp1, uvcomp2)
+    uva_sat = (max(uva, comp_max) + 1) / (1 << 16)
+    uvb_sat = (max(uvb, comp_max) + 1) / (1 << 16)
 
     # Correct for dark current
     uva -= uvd
@@ -703,8 +715,8 @@ class VEML6075:
     uvi = min(12, max(0, uvi)) # UVI must be in [0, 12]
 
     # Take integration time into consideration
-    response_uva = self.UVA_TO_IRRADIANCE / (self.itime / self.min_itime)
-    response_uvb = self.UVB_TO_IRRADIANCE / (self.itime / self.min_itime)
+    response_uva = self.response_uva
+    response_uvb = self.response_uvb
 
     '''
     # Customized DUV-based UVI calculation
@@ -729,13 +741,13 @@ class VEML6075:
       },
       'UVI' : {
         'value'     : uvi,
-        'saturation': max([uva_sat, uvb_sat]),
+        'saturation': max(uva_sat, uvb_sat),
         'again'     : 1,
         'itime'     : self.itime,
       },
       #'UVI_custom' : {
       #  'value'     : uvi_custom,
-      #  'saturation': max([uva_sat, uvb_sat]),
+      #  'saturation': max(uva_sat, uvb_sat),
       #  'again'     : 1,
       #  'itime'     : self.itime,
       #},
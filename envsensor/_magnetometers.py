@@ -1,7 +1,7 @@
+import struct
 import time
 
-from envsensor._smbus2 import SMBus
-from envsensor._utils import get_i2c_bus_number, get_word_le, get_word_be, twos_complement
+from envsensor._utils import get_i2c_bus, i2c_rdwr_read_block, get_word_be, twos_complement
 
 class HMC5883L:
   '''
@@ -78,7 +78,7 @@ class HMC5883L:
   }
 
   def __init__(self, bus, address = I2C_ADDR):
-    self.bus = SMBus(get_i2c_bus_number(bus))
+    self.bus = get_i2c_bus(bus)
     self.address = address
 
     # Verify device ID
@@ -148,7 +148,8 @@ class MMC5883MA:
   REG_DATA_Z_MSB  = 0x05
   REG_TEMPERATURE = 0x06
   REG_STATUS      = 0x07
-  # TODO: define bit fields
+  STATUS_M_DONE   = 1 << 0
+  STATUS_T_DONE   = 1 << 1
   REG_CONTROL_0   = 0x08
   CONTROL_0_TM_M  = 1 << 0
   CONTROL_0_TM_T  = 1 << 1
@@ -157,6 +158,8 @@ class MMC5883MA:
   REG_CONTROL_1   = 0x09
   CONTROL_1_RST   = 1 << 7
   REG_CONTROL_2   = 0x0a
+  CM_FREQ_OFF     = 0x0
+  CM_FREQ_14HZ    = 0x1 # Continuous measurement at 14 Hz, the fastest rate
   REG_X_THRESHOLD = 0x0b
   REG_Y_THRESHOLD = 0x0c
   REG_Z_THRESHOLD = 0x0d
@@ -168,9 +171,19 @@ class MMC5883MA:
   # add up. It should be 256 counts.
   CELSIUS_PER_LSB     = (125 - (-75)) / 256
   CELSIUS_AT_ZERO_LSB = -75
+  # X, Y and Z data registers, each unsigned 16-bit little-endian
+  DATA_M_FORMAT       = struct.Struct('<3H')
+
+  # Temperature cannot be measured continuously, so it is only refreshed once every this many reads
+  THERMAL_READ_INTERVAL = 10
+  # Offset is measured again after this many reads, with the interval doubled each time while the
+  # temperature stays stable, or immediately when temperature drifted too far (in Celsius)
+  OFFSET_INTERVAL_MIN   = 60
+  OFFSET_INTERVAL_MAX   = 3600
+  OFFSET_MAX_DRIFT      = 5.
 
   def __init__(self, bus, address = I2C_ADDR):
-    self.bus = SMBus(get_i2c_bus_number(bus))
+    self.bus = get_i2c_bus(bus)
     self.address = address
 
     # Verify chip ID
@@ -182,12 +195,15 @@ class MMC5883MA:
     # This seems to be the most suitable for ambient magnetic field.
     self.bus.write_byte_data(self.address, self.REG_CONTROL_1, self.CONTROL_1_RST)
     self._measure_offset()
+    self.offset_interval = self.OFFSET_INTERVAL_MIN
+    self.reads_until_offset = self.offset_interval
+    self._start_continuous()
+    self.reads_until_thermal = 0
 
   def read_channels(self):
-    t = self._read_thermal()
-    # TODO: offset should be measured again if temperature changed a lot, but this could introduce
-    # discontinuities (jumps) in data (so probably run LPF over offset)
-    x, y, z = self._read_magnetic()
+    # TODO: re-measuring the offset could introduce discontinuities (jumps) in data (so probably
+    # run LPF over offset)
+    x, y, z, t = self._read_all()
     return {
       'magnetic': {
         'X' : x,
@@ -199,6 +215,22 @@ class MMC5883MA:
       },
     }
 
+  def _start_continuous(self):
+    # Keep measuring the magnetic field in the background, so reads do not have to trigger a
+    # measurement and wait for it
+    self.bus.write_byte_data(self.address, self.REG_CONTROL_2, self.CM_FREQ_14HZ)
+    time.sleep(1. / 14 + 0.02) # wait for the first sample
+
+  def _recalibrate(self, next_interval):
+    # Offset can only be measured in single measurement mode
+    self.bus.write_byte_data(self.address, self.REG_CONTROL_2, self.CM_FREQ_OFF)
+    time.sleep(0.02) # let the last continuous measurement finish
+    self._read_data_m() # clear the status it left behind
+    self._measure_offset()
+    self.offset_interval = next_interval
+    self.reads_until_offset = next_interval
+    self._start_continuous()
+
   def _measure_offset(self):
     self.offset = (0., 0., 0.)
     self.offset_temperature = self._read_thermal()
@@ -214,31 +246,56 @@ class MMC5883MA:
     self.bus.write_byte_data(self.address, self.REG_CONTROL_0, 0x00)
     self.offset = ((x1 + x2) / 2, (y1 + y2) / 2, (z1 + z2) / 2)
 
-  def _convert_m(self, data, offset):
+  def _convert_m(self, raw_x, raw_y, raw_z):
     # MMC5883MA always use full 16-bit range, unsigned, 0 at 32768
-    return (get_word_le(data, offset) - (1 << 15)) * self.MICROTESLA_PER_LSB
+    x = (raw_x - (1 << 15)) * self.MICROTESLA_PER_LSB - self.offset[0]
+    y = (raw_y - (1 << 15)) * self.MICROTESLA_PER_LSB - self.offset[1]
+    z = (raw_z - (1 << 15)) * self.MICROTESLA_PER_LSB - self.offset[2]
+    return x, y, z
+
+  def _convert_t(self, raw_t):
+    return raw_t * self.CELSIUS_PER_LSB + self.CELSIUS_AT_ZERO_LSB
+
+  def _wait_ready(self, mask):
+    # Measurement takes 10 ms typical, so poll the status with increasing intervals after most of
+    # it has elapsed instead of sleeping for the worst case
+    # NOTE: reading data will clear status, so we need to read it first
+    time.sleep(0.008)
+    deadline = time.monotonic() + 0.025
+    interval = 0.001
+    while True:
+      status = self.bus.read_byte_data(self.address, self.REG_STATUS)
+      if status & mask == mask:
+        return
+      if time.monotonic() > deadline:
+        raise IOError('Sensor not in RDY state (0x{:02x})'.format(status))
+      time.sleep(interval)
+      interval = min(interval * 2, 0.004)
+
+  def _read_all(self):
+    if self.reads_until_thermal == 0:
+      self.temperature = self._read_thermal()
+      self.reads_until_thermal = self.THERMAL_READ_INTERVAL
+      if abs(self.temperature - self.offset_temperature) > self.OFFSET_MAX_DRIFT:
+        self._recalibrate(self.OFFSET_INTERVAL_MIN)
+    self.reads_until_thermal -= 1
+    self.reads_until_offset -= 1
+    if self.reads_until_offset <= 0:
+      self._recalibrate(min(self.offset_interval * 2, self.OFFSET_INTERVAL_MAX))
+    # NOTE: in continuous mode the data registers always hold the latest sample
+    return self._read_data_m() + (self.temperature, )
 
   def _read_magnetic(self, set_reset = 0x00):
     self.bus.write_byte_data(self.address, self.REG_CONTROL_0, self.CONTROL_0_TM_M | set_reset)
-    time.sleep(0.02) # actual: 10 ms typical
-    # NOTE: reading data will clear status, so we need to read it first
-    status = self.bus.read_byte_data(self.address, self.REG_STATUS)
-    if status & 0x01 != 0x01:
-      raise IOError('Sensor not in RDY state (0x{:02x})'.format(status))
-    base = self.REG_DATA_X_LSB
-    length = self.REG_DATA_Z_MSB - base + 1
-    data = self.bus.read_i2c_block_data(self.address, base, length)
-    x = self._convert_m(data, self.REG_DATA_X_LSB - base) - self.offset[0]
-    y = self._convert_m(data, self.REG_DATA_Y_LSB - base) - self.offset[1]
-    z = self._convert_m(data, self.REG_DATA_Z_LSB - base) - self.offset[2]
-    return x, y, z
+    self._wait_ready(self.STATUS_M_DONE)
+    return self._read_data_m()
+
+  def _read_data_m(self):
+    data = i2c_rdwr_read_block(
+        self.bus, self.address, self.REG_DATA_X_LSB, self.DATA_M_FORMAT.size)
+    return self._convert_m(*self.DATA_M_FORMAT.unpack_from(data))
 
   def _read_thermal(self):
     self.bus.write_byte_data(self.address, self.REG_CONTROL_0, self.CONTROL_0_TM_T)
-    time.sleep(0.02) # actual: 10 ms typical
-    # NOTE: reading data will clear status, so we need to read it first
-    status = self.bus.read_byte_data(self.address, self.REG_STATUS)
-    if status & 0x02 != 0x02:
-      raise IOError('Sensor not in RDY state (0x{:02x})'.format(status))
-    return (self.bus.read_byte_data(self.address, self.REG_TEMPERATURE) *
-        self.CELSIUS_PER_LSB + self.CELSIUS_AT_ZERO_LSB)
+    self._wait_ready(self.STATUS_T_DONE)
+    return self._convert_t(self.bus.read_byte_data(self.address, self.REG_TEMPERATURE))
@@ -1,8 +1,10 @@
 import traceback as tb
 import inspect
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import collectd
-from envsensor._smbus2 import i2c_msg
+from envsensor._smbus2 import SMBus, i2c_msg
 
 def get_calling_module_name():
   '''
@@ -84,16 +86,16 @@ def parse_collectd_config(config_keys, config, drivers):
 
   # Parse config
   config_keys_case_insensitive = {k.lower(): (k, v) for k, v in config_keys.items()}
+  driver_names = get_classes(drivers)
   for node in config.children:
-    key = node.key.lower()
+    key_entry = config_keys_case_insensitive.get(node.key.lower())
 
-    if key in config_keys_case_insensitive.keys():
-      variable_name = config_keys_case_insensitive.get(key)[0]
-      expected_type, append, _ = config_keys_case_insensitive.get(key)[1]
+    if key_entry != None:
+      variable_name, (expected_type, append, _) = key_entry
       if len(node.values) != 1:
         raise ValueError('Config key not followed by exactly 1 value: ' + str(node.values))
       val = node.values[0]
-      check_value_by_type(val, expected_type, get_classes(drivers))
+      check_value_by_type(val, expected_type, driver_names)
       if append:
         instance_config[variable_name].append(val)
       else:
@@ -118,6 +120,45 @@ def get_i2c_bus_number(s):
     raise ValueError('Unsupported bus: ' + s)
   return int(s[len('i2c-'):], 10)
 
+class SharedSMBus:
+  '''
+  Wraps an SMBus object so it can be shared by sensors driven from different threads.
+
+  Each method call holds the bus lock, so the slave address selected by one call cannot be changed
+  by another call before the transfer completes.
+  '''
+
+  def __init__(self, number):
+    self._bus = SMBus(number)
+    self._lock = threading.Lock()
+    self._methods = dict()
+
+  def __getattr__(self, name):
+    method = self._methods.get(name)
+    if method == None:
+      target = getattr(self._bus, name)
+      if not callable(target):
+        return target
+      def method(*args, **kwargs):
+        with self._lock:
+          return target(*args, **kwargs)
+      self._methods[name] = method
+    return method
+
+_i2c_buses = dict()
+_i2c_buses_lock = threading.Lock()
+
+def get_i2c_bus(s):
+  '''
+  Returns a SharedSMBus for strings like "i2c-1". Sensors on the same bus share one file descriptor.
+  '''
+
+  number = get_i2c_bus_number(s)
+  with _i2c_buses_lock:
+    if number not in _i2c_buses.keys():
+      _i2c_buses[number] = SharedSMBus(number)
+    return _i2c_buses[number]
+
 def i2c_rdwr_write(bus, address, data):
   '''
   Writes I2C bus without sending the register address.
@@ -135,6 +176,18 @@ def i2c_rdwr_read(bus, address, length):
   bus.i2c_rdwr(msg_r)
   return msg_r.buf[0:length]
 
+def i2c_rdwr_read_block(bus, address, register, length):
+  '''
+  Reads a block of data starting from the register address, in a single combined I2C transaction.
+
+  Unlike SMBus block read, this is a single I2C_RDWR ioctl and the result is returned as bytes.
+  '''
+
+  msg_w = i2c_msg.write(address, [register])
+  msg_r = i2c_msg.read(address, length)
+  bus.i2c_rdwr(msg_w, msg_r)
+  return msg_r.buf[0:length]
+
 def get_word_le(block, offset, base = 0):
   '''
   Extracts a 16-bit little-endian value from a block of data. The offset must be aligned.
@@ -225,7 +278,8 @@ class MultiInstanceCollectdPlugin():
 
   Instance class must have the following functions:
       __init__(config, bus), where config is generated by parse_collectd_config() & bus is a string;
-      dispatch(vl), where vl is a collectd.Values instance to which values should be dispatched.
+      dispatch(vl), where vl is a collectd.Values instance to which values can be dispatched (the
+          instance may also dispatch through collectd.Values templates of its own).
 
   Drivers should be a module containing the individual drivers that will be utilized by the instance
   class, each as a separate class.
@@ -239,6 +293,8 @@ class MultiInstanceCollectdPlugin():
     self._drivers = drivers
     self._configs = []
     self._instances = []
+    self._values = dict()
+    self._executor = None
     # NOTE: collectd callbacks must be registered in the plugin module
 
   def do_config(self, config):
@@ -271,15 +327,36 @@ class MultiInstanceCollectdPlugin():
           loge(
               'Instance for "{}" on bus {} failed to initialize'.format(driver, bus),
               self._plugin_name)
+    # Each instance gets its own Values, built once, since instances may be dispatching concurrently
+    self._values = {instance: collectd.Values(plugin = 'envsensor') for instance in self._instances}
+    # Instances mostly wait for measurements to complete, and instances on different buses do not
+    # contend for the bus, so with more than one they are read in parallel
+    if len(self._instances) > 1:
+      self._executor = ThreadPoolExecutor(max_workers = len(self._instances))
 
   def do_read(self):
     '''
     Dispatches values from all instances.
     '''
 
-    vl = collectd.Values(plugin = 'envsensor')
-    for instance in self._instances:
-      try:
-        instance.dispatch(vl)
-      except:
-        loge('Dispatch failed!', self._plugin_name)
+    if self._executor is None:
+      for instance in self._instances:
+        self._dispatch_instance(instance)
+    else:
+      # Consume the results so that all instances are done before returning
+      for _ in self._executor.map(self._dispatch_instance, self._instances):
+        pass
+
+  def do_shutdown(self):
+    '''
+    Stops the worker threads reading instances in parallel, if any.
+    '''
+
+    if self._executor is not None:
+      self._executor.shutdown(wait = False)
+
+  def _dispatch_instance(self, instance):
+    try:
+      instance.dispatch(self._values[instance])
+    except:
+      loge('Dispatch failed!', self._plugin_name)
@@ -38,20 +38,19 @@ def config(config_in):
           else:
             buses_hiaddr.append(int(buses[i], 10))
         except ValueError:
-          collectd.error('{}: "{}" is not a valid number, skipping'.format(__name__, buses[i]))
+          collectd.error(f'{__name__}: "{buses[i]}" is not a valid number, skipping')
     else:
-      collectd.warning('{}: Skipping unknown config key {}'.format(__name__, node.key))
+      collectd.warning(f'{__name__}: Skipping unknown config key {node.key}')
 
 def _init_one_sensor(sensors, bus, address):
   try:
     sensor = BME280(bus, address = address)
     sensors.append(sensor)
-    collectd.info(
-        '{}: Initialized sensor on i2c-{}, address 0x{:02x}'.format(__name__, bus, address))
+    collectd.info(f'{__name__}: Initialized sensor on i2c-{bus}, address 0x{address:02x}')
   except:
     collectd.error(
-        '{}: Failed to init sensor on i2c-{}, address 0x{:02x}: {}'
-            .format(__name__, bus, address, tb.format_exc()))
+        f'{__name__}: Failed to init sensor on i2c-{bus}, address 0x{address:02x}: '
+        f'{tb.format_exc()}')
 
 def init():
   global sensors, buses_hiaddr, buses_loaddr
@@ -59,8 +58,8 @@ def init():
   if not buses_hiaddr and not buses_loaddr:
     buses_hiaddr = [1]
     collectd.info(
-        '{}: Buses not set, defaulting to {}, address 0x{:02x}'
-            .format(__name__, str(buses_hiaddr), BME280_I2CADDR_HI))
+        f'{__name__}: Buses not set, defaulting to {buses_hiaddr}, '
+        f'address 0x{BME280_I2CADDR_HI:02x}')
 
   for bus in buses_hiaddr:
     if bus is None:
@@ -73,43 +72,45 @@ def init():
     else:
       _init_one_sensor(sensors, bus, BME280_I2CADDR_LO)
 
+  for sensor in sensors:
+    sensor.vl = collectd.Values(
+        type = 'gauge',
+        plugin = 'envsensor',
+        plugin_instance = f'i2c-{sensor.get_bus()}',
+        type_instance = 'BME280')
+
 def read(data = None):
   global sensors
 
-  vl = collectd.Values(type = 'gauge')
-  vl.plugin = 'envsensor'
-  vl.type_instance = 'BME280'
-
   for sensor in sensors:
-    vl.plugin_instance = 'i2c-{}'.format(sensor.get_bus())
     # NOTE: temperature must be read first
     try:
       temperature = sensor.read_temperature()
-      vl.dispatch(type = 'temperature', values = [temperature])
+      sensor.vl.dispatch(type = 'temperature', values = [temperature])
     except TimeoutError:
       # No useful data can be produced at this time
       collectd.warning(
-          '{}: sensor on i2c-{} with address 0x{:02x} timed out, skipping'
-              .format(__name__, sensor.get_bus(), sensor.get_address()))
+          f'{__name__}: sensor on i2c-{sensor.get_bus()} with address '
+          f'0x{sensor.get_address():02x} timed out, skipping')
       continue
     except:
       collectd.error(
-          '{}: Failed to read temperature on i2c-{}, address 0x{:02x}: {}'
-              .format(__name__, sensor.get_bus(), sensor.get_address(), tb.format_exc()))
+          f'{__name__}: Failed to read temperature on i2c-{sensor.get_bus()}, '
+          f'address 0x{sensor.get_address():02x}: {tb.format_exc()}')
     try:
       humidity = sensor.read_humidity()
-      vl.dispatch(type = 'humidity', values = [humidity])
+      sensor.vl.dispatch(type = 'humidity', values = [humidity])
     except:
       collectd.error(
-          '{}: Failed to read humidity on i2c-{}, address 0x{:02x}: {}'
-              .format(__name__, sensor.get_bus(), sensor.get_address(), tb.format_exc()))
+          f'{__name__}: Failed to read humidity on i2c-{sensor.get_bus()}, '
+          f'address 0x{sensor.get_address():02x}: {tb.format_exc()}')
     try:
       pressure = sensor.read_pressure()
-      vl.dispatch(type = 'pressure', values = [pressure])
+      sensor.vl.dispatch(type = 'pressure', values = [pressure])
     except:
       collectd.error(
-          '{}: Failed to read pressure on i2c-{}, address 0x{:02x}: {}'
-              .format(__name__, sensor.get_bus(), sensor.get_address(), tb.format_exc()))
+          f'{__name__}: Failed to read pressure on i2c-{sensor.get_bus()}, '
+          f'address 0x{sensor.get_address():02x}: {tb.format_exc()}')
 
 collectd.register_config(config)
 collectd.register_init(init)
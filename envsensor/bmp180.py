@@ -34,16 +34,16 @@ def config(config_in):
         try:
           buses[i] = int(buses[i], 10)
         except:
-          collectd.error('{}: "{}" is not a valid number, skipping'.format(__name__, buses[i]))
+          collectd.error(f'{__name__}: "{buses[i]}" is not a valid number, skipping')
     else:
-      collectd.warning('{}: Skipping unknown config key {}'.format(__name__, node.key))
+      collectd.warning(f'{__name__}: Skipping unknown config key {node.key}')
 
 def init():
   global sensors, buses
 
   if not buses:
     buses = [1]
-    collectd.info('{}: Buses not set, defaulting to {}'.format(__name__, str(buses)))
+    collectd.info(f'{__name__}: Buses not set, defaulting to {buses}')
 
   for bus in buses:
     if bus is None:
@@ -52,25 +52,28 @@ def init():
       # On a host that can run collectd, anything other than the highest-resolution mode does not make sense
       sensor = BMP085(bus, mode = BMP085_ULTRAHIGHRES)
       sensors.append(sensor)
-      collectd.info('{}: Initialized sensor on i2c-{}'.format(__name__, bus))
+      collectd.info(f'{__name__}: Initialized sensor on i2c-{bus}')
     except:
-      collectd.error('{}: Failed to init sensor on i2c-{}: {}'.format(__name__, bus, tb.format_exc()))
+      collectd.error(f'{__name__}: Failed to init sensor on i2c-{bus}: {tb.format_exc()}')
+
+  for sensor in sensors:
+    sensor.vl = collectd.Values(
+        type = 'gauge',
+        plugin = 'envsensor',
+        plugin_instance = f'i2c-{sensor.get_bus()}',
+        type_instance = 'BMP180')
 
 def read(data = None):
   global sensors
 
-  vl = collectd.Values(type = 'gauge')
-  vl.plugin = 'envsensor'
-  vl.type_instance = 'BMP180'
-
   for sensor in sensors:
-    vl.plugin_instance = 'i2c-{}'.format(sensor.get_bus())
     try:
       temperature, pressure = sensor.read_tp()
-      vl.dispatch(type = 'temperature', values = [temperature])
-      vl.dispatch(type = 'pressure', values = [pressure])
+      sensor.vl.dispatch(type = 'temperature', values = [temperature])
+      sensor.vl.dispatch(type = 'pressure', values = [pressure])
     except:
-      collectd.error('{}: Failed to read sensor on i2c-{}: {}'.format(__name__, sensor.get_bus(), tb.format_exc()))
+      collectd.error(
+          f'{__name__}: Failed to read sensor on i2c-{sensor.get_bus()}: {tb.format_exc()}')
 
 collectd.register_config(config)
 collectd.register_init(init)
@@ -283,17 +283,20 @@ def init():
         except:
           loge('Failed to init sensor on i2c-{}, address 0x{:02x}'.format(bus, address))
 
+  for sensor in sensors:
+    sensor.vl = collectd.Values(
+        plugin = 'envsensor',
+        plugin_instance = 'i2c-{}'.format(sensor.busno),
+        type_instance = 'DPS310_0x{:02x}'.format(sensor.address))
+
 def read(data = None):
   global sensors
 
-  vl = collectd.Values(plugin = 'envsensor')
   for sensor in sensors:
-    vl.plugin_instance = 'i2c-{}'.format(sensor.busno)
-    vl.type_instance = 'DPS310_0x{:02x}'.format(sensor.address)
     try:
       temp, pressure = sensor.read()
-      vl.dispatch(type = 'temperature', values = [temp])
-      vl.dispatch(type = 'pressure', values = [pressure])
+      sensor.vl.dispatch(type = 'temperature', values = [temp])
+      sensor.vl.dispatch(type = 'pressure', values = [pressure])
     except:
       loge('Failed to read sensor on i2c-{}, address 0x{:02x}'.format(sensor.busno, sensor.address))
 
@@ -140,21 +140,23 @@ def init():
     except:
       loge('Failed to init sensor on i2c-{}'.format(bus))
 
+  for sensor in sensors:
+    sensor.vl = collectd.Values(
+        plugin = 'envsensor',
+        plugin_instance = 'i2c-{}'.format(sensor.busno),
+        type_instance = 'HTU21D')
+
 def read(data = None):
   global sensors
 
-  vl = collectd.Values(plugin = 'envsensor')
-  vl.type_instance = 'HTU21D'
   for sensor in sensors:
-    vl.plugin_instance = 'i2c-{}'.format(sensor.busno)
-
     try:
-      vl.dispatch(type = 'temperature', values = [sensor.read_temperature()])
+      sensor.vl.dispatch(type = 'temperature', values = [sensor.read_temperature()])
     except:
       loge('Failed to read temperature on i2c-{}'.format(sensor.busno))
 
     try:
-      vl.dispatch(type = 'humidity', values = [sensor.read_humidity()])
+      sensor.vl.dispatch(type = 'humidity', values = [sensor.read_humidity()])
     except:
       loge('Failed to read humidity on i2c-{}'.format(sensor.busno))
 
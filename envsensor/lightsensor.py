@@ -10,11 +10,20 @@ Features:
 * Multiple instance support, each with separate config and optionally multiple sensors
 '''
 
+from bisect import bisect_right
+from collections import namedtuple
+from itertools import accumulate
+
 import collectd
 
 from envsensor._utils import logi, MultiInstanceCollectdPlugin
 import envsensor._lightsensors as lightsensors
 
+# Per-channel constants used by Instance.dispatch(), computed once from the config
+_DispatchPlan = namedtuple('_DispatchPlan', (
+    'radiometric', 'min_itime', 'plugin_instance', 'type_instance',
+    'log_saturation', 'log_itime', 'log_again', 'log_total_gain'))
+
 class Instance:
   '''
   Handles an instance of plugin on a particular bus with a specified driver.
@@ -106,31 +115,76 @@ class Instance:
     self.driver_name = config['Driver'].__name__
 
     # Obtain sensor characteristics and filter out modes disallowed by config
-    self.channel_modes = self.sensor.get_channel_modes()
+    # NOTE: drivers may return their class-level tables, so copy the groups before modifying them
+    self.channel_modes = [dict(group) for group in self.sensor.get_channel_modes()]
+    again_req = config.get('AnalogGain')
+    itime_req = config.get('IntegrationTime')
+    max_itime = config.get('MaxIntegrationTime')
     for group in self.channel_modes:
-      if 'AnalogGain' in config.keys():
-        again = config['AnalogGain']
-        group['gain_table'] = (
-            dict(filter(lambda k_v: k_v[1][0] == again, group['gain_table'].items())))
-      if 'IntegrationTime' in config.keys():
-        itime = config['IntegrationTime']
-        group['gain_table'] = (
-            dict(filter(lambda k_v: k_v[1][1] == itime, group['gain_table'].items())))
-      if 'MaxIntegrationTime' in config.keys():
-        max_itime = config['MaxIntegrationTime']
-        group['gain_table'] = (
-            dict(filter(lambda k_v: k_v[1][1] <= max_itime, group['gain_table'].items())))
+      # Total gain is relative to the shortest integration time, which may be filtered out below
+      group['_min_itime'] = group['gain_table'][1][1]
+      group['gain_table'] = {
+          gain: (again, itime) for gain, (again, itime) in group['gain_table'].items()
+              if (again_req is None or again == again_req)
+              and (itime_req is None or itime == itime_req)
+              and (max_itime is None or itime <= max_itime)
+      }
       if len(group['gain_table']) == 0:
         raise RuntimeError('No supported channel mode match config given')
     self.log('permitted channel modes: ' + str(self.channel_modes))
 
-    # Build a dict of channel properties for convenience
-    self.is_radiometric = dict()
-    self.min_itime = dict()
+    # Build a dispatch plan for each channel the config says should be logged
+    self.dispatch_plan = dict()
     for group in self.channel_modes:
+      min_itime = group['_min_itime']
       for name, radiometric in group['channels'].items():
-        self.is_radiometric[name] = radiometric
-        self.min_itime[name] = group['gain_table'][1][1]
+        if not config['LogRadiometric' if radiometric else 'LogPerceptive']:
+          continue
+        # Additional information is only logged for radiometric channels
+        self.dispatch_plan[name] = _DispatchPlan(
+            radiometric     = radiometric,
+            min_itime       = min_itime,
+            plugin_instance = None if radiometric else bus + '_' + name,
+            type_instance   = self.driver_name + '_' + name if radiometric else None,
+            log_saturation  = radiometric and config['LogSaturation'],
+            log_itime       = radiometric and config['LogIntegrationTime'],
+            log_again       = radiometric and config['LogAnalogGain'],
+            log_total_gain  = radiometric and config['LogTotalGain'])
+
+    # Precompute per-group values used by measure() on every read
+    for group in self.channel_modes:
+      group['_first_name'] = next(iter(group['channels']))
+      group['_sorted_gains'] = sorted(group['gain_table'].keys())
+      group['_min_mode'] = group['gain_table'][group['_sorted_gains'][0]]
+      # (gain, itime) in the same order as the sorted gains, and the longest integration time among
+      # the first n + 1 of them, so measure() does not need to look up and compare every mode
+      group['_sorted_itimes'] = tuple(
+          (gain, group['gain_table'][gain][1]) for gain in group['_sorted_gains'])
+      group['_max_itimes'] = tuple(accumulate(
+          [itime for _, itime in group['_sorted_itimes']], max))
+    self._gain_margin = config['GainMargin']
+    self._max_saturation = config['MaxSaturation']
+
+    # If config leaves only one mode for each group there is nothing to control, so set the modes
+    # once and skip the estimation pass
+    if all([len(group['gain_table']) == 1 for group in self.channel_modes]):
+      for group in self.channel_modes:
+        again, itime = group['_min_mode']
+        self.sensor.set_channel_mode(group['_first_name'], again, itime)
+      self.measure = self.sensor.read_channels
+
+    self.vl_irradiance = collectd.Values(
+        plugin = 'envsensor', type = 'count', plugin_instance = bus + '_irradiance-W-m2')
+    self.vl_perceptive = collectd.Values(
+        plugin = 'envsensor', type = 'gauge', type_instance = self.driver_name)
+    self.vl_saturation = collectd.Values(
+        plugin = 'envsensor', type = 'percent', plugin_instance = bus)
+    self.vl_itime = collectd.Values(
+        plugin = 'envsensor', type = 'duration', plugin_instance = bus)
+    self.vl_again = collectd.Values(
+        plugin = 'envsensor', type = 'gauge', plugin_instance = bus + '_gain')
+    self.vl_total_gain = collectd.Values(
+        plugin = 'envsensor', type = 'gauge', plugin_instance = bus + '_total-gain')
 
   def log(self, msg):
     logi('{} on bus {}, {}'.format(self.driver_name, self.bus, msg))
@@ -138,37 +192,45 @@ class Instance:
   def measure(self):
     # Estimate proper setting
     for group in self.channel_modes:
-      name = list(group['channels'].keys())[0]
-      min_again, min_itime = group['gain_table'][1]
-      self.sensor.set_channel_mode(name, min_again, min_itime)
+      min_again, min_itime = group['_min_mode']
+      self.sensor.set_channel_mode(group['_first_name'], min_again, min_itime)
     results_estimate = self.sensor.read_channels()
 
     # Optimize modes and try again
     # NOTE: this 2-step strategy may not always extract all the dynamic range of the sensor
-    max_new_gain = 1
+    gain_changed = False
     for group in self.channel_modes:
-      names = group['channels'].keys()
-      max_saturation = max([results_estimate[n]['saturation'] for n in names])
-      extra_gain = 1. / max_saturation / (1 + self.config['GainMargin'])
-      allowed_modes = {
-          gain: mode for gain, mode in group['gain_table'].items() if gain <= extra_gain}
-      #self.log('Gain table: {}'.format(str(group['gain_table'])))
+      gain_table = group['gain_table']
+      sorted_gains = group['_sorted_gains']
+      min_gain = sorted_gains[0]
+      max_saturation = max(results_estimate[n]['saturation'] for n in group['channels'])
+      # Relative to the estimation mode, which config filtering may have left above total gain 1
+      extra_gain = 1. / max_saturation / (1 + self._gain_margin)
+      n_allowed = bisect_right(sorted_gains, extra_gain * min_gain)
+      #self.log('Gain table: {}'.format(str(gain_table)))
       #self.log('Max sat: {}, extra gain: {}'.format(max_saturation, extra_gain))
-      #self.log('Allowed modes: {}'.format(str(allowed_modes)))
-      if len(allowed_modes) == 0:
-        new_gain = 1
+      #self.log('Allowed gains: {}'.format(str(sorted_gains[:n_allowed])))
+      if n_allowed == 0:
+        # Even the estimation mode leaves less than the margin, so keep it
+        new_gain = min_gain
       else:
         # Prioritize integration time for best SNR
         # NOTE: simply choosing the longest integration time may backfire for sensors with gains
         # spacing very far apart (e.g. TSL2591), so relaxing the requirement with some heuristics
-        max_itime = max([mode[1] for mode in allowed_modes.values()])
+        max_itime = group['_max_itimes'][n_allowed - 1]
         #self.log('Max itime: {}'.format(max_itime))
-        new_gain = max([gain for gain, mode in allowed_modes.items() if mode[1] >= max_itime / 2.])
+        # Highest allowed gain first, so the first match is the one to use
+        new_gain = next(
+            gain for gain, itime in reversed(group['_sorted_itimes'][:n_allowed])
+                if itime >= max_itime / 2.)
         #self.log('Selected gain: {}'.format(new_gain))
-      again, itime = group['gain_table'][new_gain]
-      self.sensor.set_channel_mode(list(names)[0], again, itime)
-      max_new_gain = max([max_new_gain, new_gain])
-    if max_new_gain == 1:
+      # The estimation mode is still programmed, e.g. when the estimate is (nearly) saturated
+      if new_gain == min_gain:
+        continue
+      again, itime = gain_table[new_gain]
+      self.sensor.set_channel_mode(group['_first_name'], again, itime)
+      gain_changed = True
+    if not gain_changed:
       #self.log('skipping second pass of measurements due to insufficient gain margin')
       return results_estimate
     else:
@@ -177,64 +239,45 @@ class Instance:
     # Check saturated channels (due to dynamics) and revert them
     for name in results.keys():
       saturation = results[name]['saturation']
-      if saturation > self.config['MaxSaturation']:
-        self.log('reverting channel ' + str(names) + ' due to saturation: ' + str(saturation))
+      if saturation > self._max_saturation:
+        self.log('reverting channel ' + name + ' due to saturation: ' + str(saturation))
         results[name] = results_estimate[name]
     return results
 
   def dispatch(self, vl):
     for name, result in self.measure().items():
-      value, saturation, again, itime = map(result.get, ('value', 'saturation', 'again', 'itime'))
-      radiometric = self.is_radiometric[name]
-      perceptive = not radiometric
-      itime_gain = float(itime) / self.min_itime[name]
+      plan = self.dispatch_plan.get(name)
       # Skip if the config says this channel should be ignored
-      if (
-          (radiometric and not self.config['LogRadiometric'])
-          or (perceptive and not self.config['LogPerceptive'])):
+      if plan == None:
         continue
 
       # Log value
-      if radiometric:
-        vl.dispatch(
-            type = 'count',
-            plugin_instance = self.bus + '_irradiance-W-m2',
-            type_instance = self.driver_name + '_' + name,
-            values = [value])
-      if perceptive:
-        vl.dispatch(
-            type = 'gauge',
-            plugin_instance = self.bus + '_' + name,
-            type_instance = self.driver_name,
-            values = [value])
-
-      # Log additional information as enabled by config, but only for radiometric channels
-      if not radiometric:
+      if not plan.radiometric:
+        self.vl_perceptive.dispatch(
+            plugin_instance = plan.plugin_instance,
+            values = [result['value']])
         continue
-      if self.config['LogSaturation']:
-        vl.dispatch(
-            type = 'percent',
-            plugin_instance = self.bus,
-            type_instance = self.driver_name + '_' + name,
-            values = [saturation * 100])
-      if self.config['LogIntegrationTime']:
-        vl.dispatch(
-            type = 'duration',
-            plugin_instance = self.bus,
-            type_instance = self.driver_name + '_' + name,
-            values = [itime])
-      if self.config['LogAnalogGain']:
-        vl.dispatch(
-            type = 'gauge',
-            plugin_instance = self.bus + '_gain',
-            type_instance = self.driver_name + '_' + name,
-            values = [again])
-      if self.config['LogTotalGain']:
-        vl.dispatch(
-            type = 'gauge',
-            plugin_instance = self.bus + '_total-gain',
-            type_instance = self.driver_name + '_' + name,
-            values = [again * itime_gain])
+      self.vl_irradiance.dispatch(
+          type_instance = plan.type_instance,
+          values = [result['value']])
+
+      # Log additional information as enabled by config
+      if plan.log_saturation:
+        self.vl_saturation.dispatch(
+            type_instance = plan.type_instance,
+            values = [result['saturation'] * 100])
+      if plan.log_itime:
+        self.vl_itime.dispatch(
+            type_instance = plan.type_instance,
+            values = [result['itime']])
+      if plan.log_again:
+        self.vl_again.dispatch(
+            type_instance = plan.type_instance,
+            values = [result['again']])
+      if plan.log_total_gain:
+        self.vl_total_gain.dispatch(
+            type_instance = plan.type_instance,
+            values = [result['again'] * float(result['itime']) / plan.min_itime])
 
 '''
 Example config block:
@@ -298,6 +341,10 @@ def do_init(*args, **kwargs):
 def do_read(*args, **kwargs):
   plugin.do_read(*args, **kwargs)
 
+def do_shutdown(*args, **kwargs):
+  plugin.do_shutdown(*args, **kwargs)
+
 collectd.register_config(do_config)
 collectd.register_init(do_init)
 collectd.register_read(do_read)
+collectd.register_shutdown(do_shutdown)
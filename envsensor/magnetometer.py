@@ -48,14 +48,33 @@ class Instance:
     self.bus = bus
     self.driver_name = config['Driver'].__name__
 
-    self.baseline = self.sensor.read_channels()['magnetic']
+    measurement = self.sensor.read_channels()
+    baseline = measurement['magnetic']
     if config['LogEuclidean']:
-      self.baseline['Euclidean'] = Instance._get_euclidean(self.baseline)
+      baseline['Euclidean'] = Instance._get_euclidean(baseline)
+    # Fix the order of logged channels once, so the filters below can work on plain lists
+    self.names = tuple(
+        name for name in baseline.keys() if name == 'Euclidean' or config['LogAxes'])
+    self.baseline = [baseline[name] for name in self.names]
     if config['LogDelta']:
-      self.delta_baseline = self.baseline.copy()
+      self.delta_baseline = list(self.baseline)
+
+    # Build type instance strings once rather than on every dispatch
+    self.type_instances = tuple(self.driver_name + '_' + name for name in self.names)
+    self.thermal_type_instances = {
+        name: self.driver_name + (name if name == '' else '_' + name)
+            for name in measurement.get('thermal', dict()).keys()
+    }
+
+    self.vl_instant = collectd.Values(
+        plugin = 'envsensor', type = 'gauge', plugin_instance = bus + '_uT')
+    self.vl_delta = collectd.Values(
+        plugin = 'envsensor', type = 'gauge', plugin_instance = bus + '_uT-delta')
+    self.vl_thermal = collectd.Values(
+        plugin = 'envsensor', type = 'temperature', plugin_instance = bus)
 
   def _get_euclidean(channels):
-    return math.sqrt(sum([value ** 2 for _, value in channels.items()]))
+    return math.hypot(*channels.values())
 
   def dispatch(self, vl):
     measurement = self.sensor.read_channels()
@@ -63,43 +82,30 @@ class Instance:
     thermal_channels = measurement['thermal'] if 'thermal' in measurement.keys() else dict()
     if self.config['LogEuclidean']:
       magnetic_channels['Euclidean'] = Instance._get_euclidean(magnetic_channels)
+    values = [magnetic_channels[name] for name in self.names]
 
     if self.config['LogInstant']:
+      # NOTE: b * (1 - alpha) + v * alpha == b + (v - b) * alpha
       alpha = self.config['Alpha']
-      for name, value in magnetic_channels.items():
-        if name == 'Euclidean' and not self.config['LogEuclidean']:
-          continue
-        if name != 'Euclidean' and not self.config['LogAxes']:
-          continue
-        value = self.baseline[name] * (1 - alpha) + value * alpha
-        self.baseline[name] = value
-        vl.dispatch(
-            type = 'gauge',
-            plugin_instance = self.bus + '_uT',
-            type_instance = self.driver_name + '_' + name,
+      self.baseline = [b + (v - b) * alpha for b, v in zip(self.baseline, values)]
+      for type_instance, value in zip(self.type_instances, self.baseline):
+        self.vl_instant.dispatch(
+            type_instance = type_instance,
             values = [value])
 
     if self.config['LogDelta']:
       alpha = self.config['DeltaAlpha']
-      for name, value in magnetic_channels.items():
-        if name == 'Euclidean' and not self.config['LogEuclidean']:
-          continue
-        if name != 'Euclidean' and not self.config['LogAxes']:
-          continue
-        delta = value - self.delta_baseline[name]
-        self.delta_baseline[name] = self.delta_baseline[name] * (1 - alpha) + value * alpha
-        vl.dispatch(
-            type = 'gauge',
-            plugin_instance = self.bus + '_uT-delta',
-            type_instance = self.driver_name + '_' + name,
+      deltas = [v - b for b, v in zip(self.delta_baseline, values)]
+      self.delta_baseline = [b + d * alpha for b, d in zip(self.delta_baseline, deltas)]
+      for type_instance, delta in zip(self.type_instances, deltas):
+        self.vl_delta.dispatch(
+            type_instance = type_instance,
             values = [delta])
 
     if self.config['LogTemperature']:
       for name, value in thermal_channels.items():
-        vl.dispatch(
-            type = 'temperature',
-            plugin_instance = self.bus,
-            type_instance = self.driver_name + (name if name == '' else '_' + name),
+        self.vl_thermal.dispatch(
+            type_instance = self.thermal_type_instances[name],
             values = [value])
 
 '''
@@ -161,6 +167,10 @@ def do_init(*args, **kwargs):
 def do_read(*args, **kwargs):
   plugin.do_read(*args, **kwargs)
 
+def do_shutdown(*args, **kwargs):
+  plugin.do_shutdown(*args, **kwargs)
+
 collectd.register_config(do_config)
 collectd.register_init(do_init)
 collectd.register_read(do_read)
+collectd.register_shutdown(do_shutdown)
@@ -6,14 +6,39 @@
 import time
 import struct
 import threading
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
 
 import collectd
-from envsensor._smbus2 import SMBus
-from envsensor._utils import logi, logw, loge, get_i2c_bus_number, i2c_rdwr_read, i2c_rdwr_write
+from envsensor._smbus2 import SMBus, i2c_msg
+from envsensor._utils import logi, logw, loge, get_i2c_bus_number, i2c_rdwr_read
 
 class SensorNotReadyError(Exception):
   pass
 
+def _crc8_byte(byte):
+  crc = byte
+  for _ in range(8):
+    if crc & 0x80:
+      crc = (crc << 1) ^ 0x31 # XOR with polynominal
+    else:
+      crc <<= 1
+  return crc & 0xff
+
+# CRC-8 lookup table for polynominal 0x31, indexed by (crc ^ byte)
+_CRC8_TABLE = bytes([_crc8_byte(b) for b in range(256)])
+
+def _crc8_two_bytes(hi, lo):
+  return _CRC8_TABLE[_CRC8_TABLE[0xff ^ hi] ^ lo] # Initialization value is 0xff
+
+def _prepack_commands(commands):
+  # The comprehension should not be inlined in the beginning of the class, since they cannot access
+  # class-scope variables when carried out outside functions.
+  return {
+      name: struct.pack('>H', cmd)
+          for name, (cmd, param_len, _, _) in commands.items() if param_len == 0
+  }
+
 class SGP30:
   # NOTE: SGP30's address is always 0x58. Only 1 sensor can be on a bus unless an address translator
   # is used.
@@ -21,6 +46,7 @@ class SGP30:
   EXPECTED_PRODUCT_TYPE = 0x0
   EXPECTED_FEATSET_MIN  = 0x20
   EXPECTED_TEST_RESULT  = 0xd400
+  ERROR_LOG_INTERVAL    = 60 # seconds
 
   # {command name, (command word, parameter word count, response word count, max wait millis)}
   # For parameter/response, each word is 3 bytes due to the inclusion of CRC
@@ -38,13 +64,25 @@ class SGP30:
       'get_tvoc_baseline'       : (0x20b3, 0, 1,  10),
       'set_tvoc_baseline'       : (0x2077, 1, 0,  10),
   }
+  # Outgoing frames for commands without parameters
+  prepacked_commands = _prepack_commands(commands)
 
   def __init__(self, bus, log_baseline, i2c_addr = I2C_ADDR):
     self.bus = bus
     self.log_baseline = log_baseline
     self._i2c_dev = SMBus(get_i2c_bus_number(bus))
     self._i2c_addr = i2c_addr
+    # Messages for commands without parameters never change, so they are built once and reused
+    self._command_msgs = {
+        name: i2c_msg.write(i2c_addr, data_out)
+            for name, data_out in self.prepacked_commands.items()
+    }
     self._ready = False
+    self._uid = None
+    self._t_last_error = None
+    self._suppressed_errors = 0
+    # {command name: (raw response, verified words)} of the last valid response
+    self._last_responses = dict()
     test_result = self.command('measure_test')[0]
     if test_result != self.EXPECTED_TEST_RESULT:
       raise IOError('Sensor self-test failed (0x{:04x})!'.format(test_result))
@@ -54,16 +92,35 @@ class SGP30:
             .format(self.get_unique_id(), self.bus, self.get_feature_set_version()[1]))
 
   def get_air_quality(self):
-    eco2, tvoc = self.command('measure_iaq')
+    return self.check_air_quality(*self.command('measure_iaq'))
+
+  def check_air_quality(self, eco2, tvoc):
     if not self._ready and eco2 == 400 and tvoc == 0:
       raise SensorNotReadyError()
     else:
       self._ready = True # no more checks
       return eco2, tvoc
 
+  def log_read_error(self):
+    # Formatting the stack trace is expensive, so when a sensor keeps failing only log once in a
+    # while and count the rest
+    t_now = time.monotonic()
+    if self._t_last_error is not None and t_now - self._t_last_error < self.ERROR_LOG_INTERVAL:
+      self._suppressed_errors += 1
+      return
+    message = 'Failed to read sensor on {}'.format(self.bus)
+    if self._suppressed_errors > 0:
+      message += ' ({} more failures since last report)'.format(self._suppressed_errors)
+    loge(message)
+    self._t_last_error = t_now
+    self._suppressed_errors = 0
+
   def get_unique_id(self):
-    result = self.command('get_serial_id')
-    return result[0] << 32 | result[1] << 16 | result[2]
+    # The serial ID is stored in ROM, so it only needs to be read once
+    if self._uid is None:
+      result = self.command('get_serial_id')
+      self._uid = result[0] << 32 | result[1] << 16 | result[2]
+    return self._uid
 
   def get_feature_set_version(self):
     result = self.command('get_feature_set_version')[0]
@@ -78,84 +135,278 @@ class SGP30:
     self.command('set_iaq_baseline', (tvoc, eco2))
 
   def command(self, command_name, parameters = None):
-    if parameters is None:
-      parameters = []
-    parameters = list(parameters)
-    cmd, param_len, response_len, wait_millis = self.commands[command_name]
-    if len(parameters) != param_len:
+    wait_millis = self.send_command(command_name, parameters)
+    time.sleep(wait_millis / 1000.)
+    return self.receive_response(command_name)
+
+  def send_command(self, command_name, parameters = None):
+    '''
+    Sends a command without waiting for it to complete. Returns the time to wait in milliseconds.
+    '''
+
+    cmd, param_len, _, wait_millis = self.commands[command_name]
+    n_parameters = len(parameters) if parameters else 0
+    if n_parameters != param_len:
       raise ValueError(
-          "{} wants {} parameters, got {}".format(command_name, param_len, len(parameters)))
+          "{} wants {} parameters, got {}".format(command_name, param_len, n_parameters))
 
-    parameters_out = [cmd]
-    for i in range(len(parameters)):
-      parameters_out.append(parameters[i])
-      parameters_out.append(SGP30.calculate_crc_for_word(parameters[i]))
-    data_out = struct.pack('>H' + ('HB' * param_len), *parameters_out)
+    if n_parameters == 0:
+      # Common case in the polling loop, nothing is allocated
+      msg_w = self._command_msgs[command_name]
+    else:
+      # tuple() is a no-op for tuples, and makes other sequences hashable for the cache
+      msg_w = i2c_msg.write(self._i2c_addr, SGP30.pack_command(cmd, tuple(parameters)))
 
-    i2c_rdwr_write(self._i2c_dev, self._i2c_addr, data_out)
-    time.sleep(wait_millis / 1000.)
+    self._i2c_dev.i2c_rdwr(msg_w)
+    return wait_millis
+
+  def receive_response(self, command_name):
+    '''
+    Reads and verifies the response of a command sent by send_command(), if it has one.
+    '''
 
+    response_len = self.commands[command_name][2]
     if response_len > 0:
       # Each parameter is a word (2 bytes) followed by a CRC (1 byte)
       buf = i2c_rdwr_read(self._i2c_dev, self._i2c_addr, response_len * 3)
-      response = struct.unpack('>' + ('HB' * response_len), buf)
+      # Readings often stay the same for many seconds, and bytes identical to a response that
+      # passed the CRC check do not need to be checked again
+      last_buf, last_verified = self._last_responses.get(command_name, (None, None))
+      if buf == last_buf:
+        return list(last_verified)
 
       verified = []
-      for i in range(response_len):
-        offset = i * 2
-        value, crc = response[offset:offset + 2]
-        if crc != SGP30.calculate_crc_for_word(value):
+      crc8 = _crc8_two_bytes # local lookup in the loop
+      for offset in range(0, response_len * 3, 3):
+        hi, lo, crc = buf[offset], buf[offset + 1], buf[offset + 2]
+        if crc != crc8(hi, lo):
           raise IOError("Invalid CRC in response")
-        verified.append(value)
+        verified.append(hi << 8 | lo)
+      self._last_responses[command_name] = (buf, tuple(verified))
       return verified
 
-  def calculate_crc_for_word(data):
-    crc = 0xff # Initialization value
-    for byte in [(data & 0xff00) >> 8, data & 0x00ff]:
-      crc ^= byte
-      for _ in range(8):
-        if crc & 0x80:
-          crc = (crc << 1) ^ 0x31 # XOR with polynominal
-        else:
-          crc <<= 1
-    return crc & 0xff
-
-keep_polling  = True
-data          = []
-data_lock     = threading.Lock()
-
-# Read sensor at 1 Hz rate for optimal performance, and cache the results for dispatch
-def insert_dummy_read():
-  global data, sensors
-
-  t_last_read = time.monotonic()
-  while keep_polling:
-    t_start = time.monotonic()
-    elapsed = t_start - t_last_read
-    t_last_read += 1.0
-    if elapsed < 1.0:
-      time.sleep(1.0 - elapsed)
-
-    data_lock.acquire()
-    data = []
-    for sensor in sensors:
-      data_instance = {'bus': sensor.bus}
-      try:
-        # Handle baseline first since it never raise SensorNotReadyError
-        if sensor.log_baseline:
-          data_instance['eco2_baseline'], data_instance['tvoc_baseline'] = sensor.get_baseline()
-        data_instance['eco2'], data_instance['tvoc'] = sensor.get_air_quality()
-      except SensorNotReadyError:
-        logw('Sensor on {} not ready yet'.format(sensor.bus))
-      except:
-        loge('Failed to read sensor on {}'.format(sensor.bus))
-      data.append(data_instance)
-    data_lock.release()
-
-poll_thread = threading.Thread(target = insert_dummy_read)
-
-configs     = []
-sensors     = []
+  @staticmethod
+  @lru_cache(maxsize = 64)
+  def pack_command(cmd, parameters):
+    # The same few commands and parameters (e.g. baseline) are sent over and over, so the frames
+    # including their CRCs are cached
+    # Each parameter is a word (2 bytes) followed by a CRC (1 byte)
+    data_out = bytearray(2 + 3 * len(parameters))
+    data_out[0] = cmd >> 8
+    data_out[1] = cmd & 0xff
+    offset = 2
+    for parameter in parameters:
+      hi = parameter >> 8
+      lo = parameter & 0xff
+      data_out[offset] = hi
+      data_out[offset + 1] = lo
+      data_out[offset + 2] = _crc8_two_bytes(hi, lo)
+      offset += 3
+    return bytes(data_out)
+
+def command_all(sensors, command_name, executor = None):
+  '''
+  Sends the same command to all sensors back-to-back, waits once, and then collects the responses.
+  If an executor is given, the sensors (which are on different buses) are accessed in parallel.
+
+  Returns a dict of {sensor: response}. If a sensor failed, the response is the exception raised.
+  '''
+
+  def send(sensor):
+    try:
+      return sensor.send_command(command_name)
+    except Exception as e:
+      return e
+
+  def receive(sensor):
+    try:
+      return sensor.receive_response(command_name)
+    except Exception as e:
+      return e
+
+  run = map if executor is None else executor.map
+  responses = dict()
+  wait_millis = 0
+  for sensor, result in zip(sensors, run(send, sensors)):
+    if isinstance(result, Exception):
+      responses[sensor] = result
+    else:
+      wait_millis = max(wait_millis, result)
+  time.sleep(wait_millis / 1000.)
+  pending = [sensor for sensor in sensors if sensor not in responses.keys()]
+  responses.update(zip(pending, run(receive, pending)))
+  return responses
+
+def get_response(responses, sensor):
+  response = responses[sensor]
+  if isinstance(response, Exception):
+    raise response
+  return response
+
+def config_buses(instance_config, val):
+  if not all(isinstance(s, str) for s in val):
+    raise ValueError('"{}" is not a valid list of buses'.format(val))
+  instance_config['buses'] += [s.lower() for s in val]
+
+def config_baseline(instance_config, val):
+  if len(val) != 2 or not all(isinstance(v, (int, float)) for v in val):
+    raise ValueError('"{}" is not a valid pair of baselines'.format(val))
+  instance_config['baseline'] = (round(val[0]), round(val[1]))
+
+def config_log_baseline(instance_config, val):
+  if len(val) != 1 or not isinstance(val[0], bool):
+    raise ValueError('"{}" is not a valid boolean'.format(val))
+  instance_config['log_baseline'] = val[0]
+
+# {lower-case key in collectd.conf: handler}
+config_handlers = {
+  'buses'       : config_buses,
+  'baseline'    : config_baseline,
+  'logbaseline' : config_log_baseline,
+}
+
+class SGP30Plugin:
+  '''
+  Holds the state of the plugin: configs, sensors, and the data cached by the polling thread.
+  '''
+
+  # The baselines drift over minutes, so they are read less often than the air quality
+  BASELINE_INTERVAL = 60 # seconds
+
+  def __init__(self):
+    self.configs = []
+    self.sensors = []
+    self.data = []
+    self.data_lock = threading.Lock()
+    self.stop_polling = threading.Event()
+    self.poll_thread = threading.Thread(target = self.poll)
+    self.executor = None
+
+  def config(self, config_in):
+    instance_config = dict()
+    instance_config['buses'] = []
+    instance_config['log_baseline'] = False
+    for node in config_in.children:
+      handler = config_handlers.get(node.key.lower())
+      if handler is None:
+        raise KeyError('Unknown config key: ' + node.key)
+      handler(instance_config, node.values)
+
+    self.configs.append(instance_config)
+
+  def init(self):
+    if len(self.configs) == 0:
+      logw('No config found, will not create any instance')
+
+    for instance_config in self.configs:
+      for bus in instance_config['buses']:
+        try:
+          sensor = SGP30(bus, instance_config['log_baseline'])
+          if 'baseline' in instance_config.keys():
+            eco2, tvoc = instance_config['baseline']
+            sensor.set_baseline(eco2, tvoc)
+          sensor.vl_eco2 = collectd.Values(
+              type = 'gauge', plugin = 'envsensor', type_instance = 'SGP30',
+              plugin_instance = bus + '_eCO2-ppm')
+          sensor.vl_tvoc = collectd.Values(
+              type = 'gauge', plugin = 'envsensor', type_instance = 'SGP30',
+              plugin_instance = bus + '_TVOC-ppb')
+          sensor.vl_eco2_baseline = collectd.Values(
+              type = 'gauge', plugin = 'envsensor', type_instance = 'SGP30_eCO2',
+              plugin_instance = bus + '_baseline')
+          sensor.vl_tvoc_baseline = collectd.Values(
+              type = 'gauge', plugin = 'envsensor', type_instance = 'SGP30_TVOC',
+              plugin_instance = bus + '_baseline')
+          self.sensors.append(sensor)
+        except:
+          loge('Failed to init sensor on {}'.format(bus))
+
+    # Each sensor is on its own bus, so with more than one their transfers can run in parallel
+    if len(self.sensors) > 1:
+      self.executor = ThreadPoolExecutor(max_workers = len(self.sensors))
+    if len(self.configs) != 0:
+      self.poll_thread.start()
+
+  # Read sensor at 1 Hz rate for optimal performance, and cache the results for dispatch
+  def poll(self):
+    sensors = self.sensors
+    stop_polling = self.stop_polling
+    executor = self.executor
+
+    # {sensor: baselines or exception}, kept until the next baseline read
+    baselines = dict()
+    t_next_baseline = time.monotonic()
+
+    # Schedule against absolute deadlines so that I2C latency and sleep jitter do not accumulate
+    t_next_read = time.monotonic()
+    while not stop_polling.is_set():
+      t_next_read += 1.0
+      t_late = time.monotonic() - t_next_read
+      if t_late > 1.0:
+        # Fell behind by more than a period, resync instead of bursting catch-up reads
+        t_next_read += t_late
+      elif stop_polling.wait(max(-t_late, 0.)):
+        # Woken up by shutdown()
+        break
+
+      # The sensors are only accessed by this thread, so the lock is held just for swapping in the
+      # results rather than during the whole I2C exchange
+      new_data = []
+      # Each command is sent to all sensors before waiting, so sensors on different buses measure
+      # at the same time. Commands to the same sensor cannot be overlapped though: the SGP30 does
+      # not queue commands and NACKs any I2C transfer while a command is executing, and reading a
+      # response is the only way to retrieve it before the next command overwrites it.
+      t_now = time.monotonic()
+      baseline_due = t_now >= t_next_baseline
+      if baseline_due:
+        t_next_baseline = t_now + self.BASELINE_INTERVAL
+      # Failed reads are retried on the next cycle rather than after a whole interval
+      baseline_sensors = [
+          s for s in sensors
+              if s.log_baseline and (
+                  baseline_due or s not in baselines.keys() or
+                  isinstance(baselines[s], Exception))
+      ]
+      if len(baseline_sensors) != 0:
+        baselines.update(command_all(baseline_sensors, 'get_iaq_baseline', executor))
+      air_qualities = command_all(sensors, 'measure_iaq', executor)
+      for sensor in sensors:
+        data_instance = {'sensor': sensor}
+        try:
+          # Handle baseline first since it never raise SensorNotReadyError
+          if sensor.log_baseline:
+            data_instance['eco2_baseline'], data_instance['tvoc_baseline'] = (
+                get_response(baselines, sensor))
+          data_instance['eco2'], data_instance['tvoc'] = (
+              sensor.check_air_quality(*get_response(air_qualities, sensor)))
+        except SensorNotReadyError:
+          logw('Sensor on {} not ready yet'.format(sensor.bus))
+        except:
+          sensor.log_read_error()
+        new_data.append(data_instance)
+      with self.data_lock:
+        self.data = new_data
+
+  def read(self):
+    with self.data_lock:
+      snapshot = self.data
+      self.data = []
+
+    for data_instance in snapshot:
+      sensor = data_instance['sensor']
+      if 'eco2' in data_instance.keys() and 'tvoc' in data_instance.keys():
+        sensor.vl_eco2.dispatch(values = [data_instance['eco2']])
+        sensor.vl_tvoc.dispatch(values = [data_instance['tvoc']])
+      if 'eco2_baseline' in data_instance.keys() and 'tvoc_baseline' in data_instance.keys():
+        sensor.vl_eco2_baseline.dispatch(values = [data_instance['eco2_baseline']])
+        sensor.vl_tvoc_baseline.dispatch(values = [data_instance['tvoc_baseline']])
+
+  def shutdown(self):
+    self.stop_polling.set()
+    if self.poll_thread.is_alive():
+      self.poll_thread.join()
+    if self.executor is not None:
+      self.executor.shutdown()
 
 '''
 Config example:
@@ -168,86 +419,10 @@ Import "envsensor.sgp30"
                             # the sensor internally.
 </Module>
 '''
-def config(config_in):
-  global configs
-
-  instance_config = dict()
-  instance_config['buses'] = []
-  instance_config['log_baseline'] = False
-  for node in config_in.children:
-    key = node.key.lower()
-    val = node.values
-
-    if    key == 'buses':
-      instance_config['buses'] += [s.lower() for s in val]
-    elif  key == 'baseline':
-      assert len(val) == 2
-      assert isinstance(val[0], (int, float))
-      assert isinstance(val[1], (int, float))
-      instance_config['baseline'] = (round(val[0]), round(val[1]))
-    elif  key == 'logbaseline':
-      assert len(val) == 1
-      assert isinstance(val[0], bool)
-      instance_config['log_baseline'] = val[0]
-    else:
-      raise KeyError('Unknown config key: ' + node.key)
-
-  configs.append(instance_config)
-
-def init():
-  global sensors, configs
-
-  if len(configs) == 0:
-    logw('No config found, will not create any instance')
-
-  for instance_config in configs:
-    for bus in instance_config['buses']:
-      try:
-        sensor = SGP30(bus, instance_config['log_baseline'])
-        if 'baseline' in instance_config.keys():
-          eco2, tvoc = instance_config['baseline']
-          sensor.set_baseline(eco2, tvoc)
-        sensors.append(sensor)
-      except:
-        loge('Failed to init sensor on {}'.format(bus))
-
-  if len(configs) != 0:
-    poll_thread.start()
-
-def read():
-  global data
-
-  vl = collectd.Values(type = 'gauge', plugin = 'envsensor')
-  data_lock.acquire()
-  for data_instance in data:
-    bus = data_instance['bus']
-    if 'eco2' in data_instance.keys() and 'tvoc' in data_instance.keys():
-      vl.type_instance = 'SGP30'
-      vl.dispatch(
-          plugin_instance = bus + '_eCO2-ppm',
-          values = [data_instance['eco2']])
-      vl.dispatch(
-          plugin_instance = bus + '_TVOC-ppb',
-          values = [data_instance['tvoc']])
-    if 'eco2_baseline' in data_instance.keys() and 'tvoc_baseline' in data_instance.keys():
-      vl.plugin_instance = bus + '_baseline'
-      vl.dispatch(
-          type_instance = 'SGP30_eCO2',
-          values = [data_instance['eco2_baseline']])
-      vl.dispatch(
-          type_instance = 'SGP30_TVOC',
-          values = [data_instance['tvoc_baseline']])
-  data = []
-  data_lock.release()
-
-def shutdown():
-  global keep_polling
-
-  keep_polling = False
-  if poll_thread.is_alive():
-    poll_thread.join()
-
-collectd.register_config(config)
-collectd.register_init(init)
-collectd.register_read(read)
-collectd.register_shutdown(shutdown)
+
+plugin = SGP30Plugin()
+
+collectd.register_config(plugin.config)
+collectd.register_init(plugin.init)
+collectd.register_read(plugin.read)
+collectd.register_shutdown(plugin.shutdown)
@@ -22,12 +22,30 @@ Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 """
 
 import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 import collectd
 
 from fail2ban.client.csocket import CSocket
 from fail2ban.client.configurator import Configurator
 
+# Jails only change when fail2ban reloads its config, so the list is refreshed
+# at this interval (in seconds) or after an error rather than on every read
+_JAILS_TTL = 300
+
+# A wedged server must not stall collectd's read thread, so socket operations time out
+# after this many seconds and are retried a few times with exponential backoff
+_SOCKET_TIMEOUT = 2.0
+_SEND_ATTEMPTS = 3
+_RETRY_DELAY = 0.1
+
+# Upper bound on concurrent jail status requests (and so on open connections)
+_MAX_WORKERS = 8
+
+_VALUES = collectd.Values(type='gauge', plugin='fail2ban')
+
 
 class Fail2banClient:
     """Basic Fail2ban socket client for fetching jail status."""
@@ -36,8 +54,37 @@ class Fail2banClient:
         self._configurator.setBaseDir(conf_dir)
         self._configurator.readEarly()
         self._socket = self._configurator.getEarlyOptions()["socket"]
+        # One connection per thread, so jails can be queried concurrently
+        self._local = threading.local()
+        self._jails = None
+        self._jails_time = 0
         collectd.info("Using socket file " + self._socket)
 
+    def _send(self, cmd):
+        """Sends a command, reconnecting if the connection went stale or timed out."""
+        for attempt in range(_SEND_ATTEMPTS):
+            try:
+                client = getattr(self._local, "client", None)
+                if client is None:
+                    client = self._local.client = CSocket(
+                        self._socket, timeout=_SOCKET_TIMEOUT)
+                return client.send(cmd)
+            except socket.error:
+                # e.g. server restarted since the last read, or not listening yet
+                self._close()
+                if attempt == _SEND_ATTEMPTS - 1:
+                    raise
+                time.sleep(_RETRY_DELAY * 2**attempt)
+
+    def _close(self):
+        client = getattr(self._local, "client", None)
+        if client is not None:
+            try:
+                client.close()
+            except socket.error:
+                pass
+            self._local.client = None
+
     def _process_cmd(self, jail="", listjails=False):
         cmds = []
         if listjails:
@@ -46,8 +93,7 @@ class Fail2banClient:
             cmds.append(['status', jail])
         for cmd in cmds:
             try:
-                client = CSocket(self._socket)
-                ret = client.send(cmd)
+                ret = self._send(cmd)
                 if ret[0] == 0:
                     if not listjails:
                         retval = ret[1][1][1][0][1]
@@ -58,10 +104,15 @@ class Fail2banClient:
                     collectd.warning("NOK: " + repr(ret[1].args) + " -> " +
                                      ret[1])
                     return None
+            except socket.timeout:
+                collectd.warning("Timed out waiting for server")
+                return None
             except socket.error:
                 collectd.error("Unable to contact server. Is it running?")
                 return None
             except Exception as err:
+                # The connection may be left in an unknown state
+                self._close()
                 collectd.error(err)
                 return None
 
@@ -70,26 +121,53 @@ class Fail2banClient:
         return self._process_cmd(jail)
 
     def list_jails(self):
-        """Returns a list of active jails."""
-        return self._process_cmd(listjails=True)
+        """Returns a list of active jails, cached for _JAILS_TTL seconds."""
+        now = time.monotonic()
+        if self._jails is None or now - self._jails_time >= _JAILS_TTL:
+            self._jails = self._process_cmd(listjails=True)
+            self._jails_time = now
+        return self._jails
+
+    def invalidate_jails(self):
+        """Forces the list of jails to be fetched again on next use."""
+        self._jails = None
 
 
 _CLIENT = None
+_EXECUTOR = None
 
 
 def init():
-    global _CLIENT
+    global _CLIENT, _EXECUTOR
     _CLIENT = Fail2banClient()
+    # Worker threads are kept (with their connections) across reads
+    _EXECUTOR = ThreadPoolExecutor(max_workers=_MAX_WORKERS)
     return True
 
 
 def read(_=None):
     global _CLIENT
     # NOTE: consider creating client everytime since config might change
-    values = collectd.Values(type='gauge', plugin='fail2ban')
-    for jail in _CLIENT.list_jails():
-        values.dispatch(type_instance=jail, values=[_CLIENT.get_banned(jail)])
+    values = _VALUES
+    jails = _CLIENT.list_jails()
+    if jails is None:
+        _CLIENT.invalidate_jails()
+        return
+    # Wait on all jails at once rather than paying one round-trip after another
+    results = list(_EXECUTOR.map(_CLIENT.get_banned, jails))
+    for jail, banned in zip(jails, results):
+        if banned is None:
+            # The jail may have been removed by a reload
+            _CLIENT.invalidate_jails()
+            continue
+        values.dispatch(type_instance=jail, values=[banned])
+
+
+def shutdown():
+    if _EXECUTOR is not None:
+        _EXECUTOR.shutdown(wait=False)
 
 
 collectd.register_read(read)
 collectd.register_init(init)
+collectd.register_shutdown(shutdown)
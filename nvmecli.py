@@ -1,16 +1,76 @@
-"""Monitors NVME heath status through nvme-cli.
+"""Monitors NVME heath status through NVME admin commands.
+
+The same SMART / identify data as reported by nvme-cli is fetched by issuing the admin commands
+directly through ioctl, rather than running nvme-cli and parsing its JSON output.
 
 NOTE: assuming 1 namespace per device
-Depends on: nvme-cli
+NOTE: needs CAP_SYS_ADMIN (i.e. running as root), same as nvme-cli
 """
 
-import json
+import ctypes
+import fcntl
 import os
 import re
-import subprocess
+import struct
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
 
 import collectd
 
+# From linux/nvme_ioctl.h
+_NVME_IOCTL_ID = 0x4e40  # _IO('N', 0x40)
+_NVME_IOCTL_ADMIN_CMD = 0xc0484e41  # _IOWR('N', 0x41, struct nvme_admin_cmd)
+# struct nvme_passthru_cmd: opcode, flags, rsvd1, nsid, cdw2, cdw3, metadata, addr, metadata_len,
+# data_len, cdw10 - cdw15, timeout_ms, result
+_PASSTHRU_CMD = struct.Struct('<BBHIIIQQII6III')
+
+# See NVME 1.3b Fig. 41 (opcodes), Fig. 90 (Get Log Page) and Fig. 106 (Identify)
+_ADMIN_GET_LOG_PAGE = 0x02
+_ADMIN_IDENTIFY = 0x06
+_LOG_SMART = 0x02
+_LOG_SMART_SIZE = 512
+_ID_CNS_NS = 0x00
+_ID_CNS_CTRL = 0x01
+_ID_SIZE = 4096
+_NSID_ALL = 0xffffffff
+
+# Matches controllers (nvme0), and namespaces (nvme0n1) with the namespace part in group 1
+_RE_NVME = re.compile('nvme[0-9]+(n[0-9]+)?$')
+
+# Drives are rarely added or removed, so /dev is only scanned again when its modification time
+# changes (i.e. device nodes were created or removed) or after an error, rather than on every
+# poll. This picks up changes right away at the cost of one stat() per poll.
+_devices = None
+_devices_mtime = None
+
+# Controller ID fields are static, so they are only fetched again along with the device list
+# {controller: decoded fields}
+_id_ctrl_cache = {}
+
+# Worker threads are only started when needed, and kept across reads
+_EXECUTOR = ThreadPoolExecutor(max_workers=8)
+
+# A hung drive may block its ioctl for as long as the kernel's admin timeout (60 s by default).
+# Drives that have not answered within this many seconds are skipped for the poll, and are not
+# queried again until the stuck query returns, so they do not use up the workers.
+_QUERY_TIMEOUT = 5
+
+# {device: future} of queries that did not finish in time
+_stuck_queries = {}
+
+# Drives are polled from a background thread, so a slow drive never blocks collectd's read thread.
+# read() only dispatches the latest results, and is registered with the same interval (in seconds)
+# as the polls so that each poll is dispatched once. Defaults to collectd's default Interval.
+_interval = 10.
+
+_data = None
+_data_lock = threading.Lock()
+_stop_polling = threading.Event()
+_poll_thread = None
+
+_VALUES = collectd.Values(plugin='nvmecli')
+
 
 def emit_count(values, label, data):
     """Dispatches count data."""
@@ -98,7 +158,7 @@ def emit_df(values, label, data):
 
 
 _PROPERTIES = {
-    # Each row = key as in JSON: (type instance, handler aka. formatter)
+    # Each row = field name as in nvme-cli: (type instance, handler aka. formatter)
     # See NVME 1.3b Fig. 93.
 
     # Currently not parsing bit-fields
@@ -143,46 +203,288 @@ _PROPERTIES = {
     'cctemp': ('Critical Composite', emit_temperature),
 }
 
-
-def process_cmd(values, dev, cmd):
-    """Processes command output for one drive."""
-    with subprocess.Popen(['nvme', cmd, '-o', 'json', '/dev/' + dev],
-                          stdout=subprocess.PIPE) as pipe:
-        j = json.loads(pipe.communicate()[0])
-    for key, val in list(j.items()):
-        try:
-            label, func = _PROPERTIES[key]
-            func(values, label, val)
-        except KeyError:
-            collectd.debug(f'Skipping unknown field {key}')
-
-
-def process_ns(values, namespace):
-    """Processes namespace command output for one drive."""
-    with subprocess.Popen(['nvme', 'id-ns', '-o', 'json', '/dev/' + namespace],
-                          stdout=subprocess.PIPE) as pipe:
-        j = json.loads(pipe.communicate()[0])
+# SMART / Health Information log page up to the last field used, see NVME 1.3b Fig. 94.
+# The 128-bit counters are unpacked as pairs of 64-bit halves (low, high).
+_SMART_LOG = struct.Struct('<BHBBB26x20QII8H4I')
+_SMART_LOG_FIELDS = (
+    'critical_warning',
+    'temperature',
+    'avail_spare',
+    'spare_thresh',
+    'percent_used',
+    # 128-bit
+    'data_units_read',
+    'data_units_written',
+    'host_read_commands',
+    'host_write_commands',
+    'controller_busy_time',
+    'power_cycles',
+    'power_on_hours',
+    'unsafe_shutdowns',
+    'media_errors',
+    'num_err_log_entries',
+    # End of 128-bit
+    'warning_temp_time',
+    'critical_comp_time',
+    'temperature_sensor_1',
+    'temperature_sensor_2',
+    'temperature_sensor_3',
+    'temperature_sensor_4',
+    'temperature_sensor_5',
+    'temperature_sensor_6',
+    'temperature_sensor_7',
+    'temperature_sensor_8',
+    'thm_temp1_trans_count',
+    'thm_temp2_trans_count',
+    'thm_temp1_total_time',
+    'thm_temp2_total_time',
+)
+
+# Each row = (field name, offset, size in bytes), all little-endian unsigned integers
+_ID_CTRL_FIELDS = (
+    # See NVME 1.3b Fig. 109.
+    ('wctemp', 266, 2),
+    ('cctemp', 268, 2),
+)
+
+_ID_NS_FIELDS = (
+    # See NVME 1.3b Fig. 114.
+    ('nsze', 0, 8),
+    ('ncap', 8, 8),
+    ('nuse', 16, 8),
+)
+
+
+def admin_cmd(fd, opcode, nsid, cdw10, data_len):
+    """Issues an admin command and returns the data transferred from the device."""
+    data = ctypes.create_string_buffer(data_len)
+    cmd = bytearray(
+        _PASSTHRU_CMD.pack(opcode, 0, 0, nsid, 0, 0, 0, ctypes.addressof(data), 0,
+                           data_len, cdw10, 0, 0, 0, 0, 0, 0, 0))
+    status = fcntl.ioctl(fd, _NVME_IOCTL_ADMIN_CMD, cmd)
+    if status != 0:
+        raise OSError(f'NVME admin command 0x{opcode:02x} failed with status 0x{status:x}')
+    return data.raw
+
+
+def decode(data, fields):
+    """Decodes fields as laid out in the given table from a data structure."""
+    return {
+        key: int.from_bytes(data[offset:offset + size], 'little')
+        for key, offset, size in fields
+    }
+
+
+def decode_smart_log(data):
+    """Decodes the SMART / Health Information log page."""
+    raw = _SMART_LOG.unpack_from(data)
+    wide = tuple(lo | hi << 64 for lo, hi in zip(raw[5:25:2], raw[6:25:2]))
+    return dict(zip(_SMART_LOG_FIELDS, raw[:5] + wide + raw[25:]))
+
+
+def dispatch_fields(values, fields):
+    """Dispatches decoded fields according to _PROPERTIES."""
+    for key, val in fields.items():
+        label, func = _PROPERTIES[key]
+        func(values, label, val)
+
+
+def fetch_ctrl(dev):
+    """Fetches controller ID and SMART log fields for one drive."""
+    fd = os.open('/dev/' + dev, os.O_RDONLY)
+    try:
+        id_ctrl_fields = _id_ctrl_cache.get(dev)
+        if id_ctrl_fields is None:
+            id_ctrl = admin_cmd(fd, _ADMIN_IDENTIFY, 0, _ID_CNS_CTRL, _ID_SIZE)
+            id_ctrl_fields = _id_ctrl_cache[dev] = decode(id_ctrl, _ID_CTRL_FIELDS)
+        # NUMD is 0's based and in dwords
+        smart_log = admin_cmd(fd, _ADMIN_GET_LOG_PAGE, _NSID_ALL,
+                              _LOG_SMART | (_LOG_SMART_SIZE // 4 - 1) << 16,
+                              _LOG_SMART_SIZE)
+    finally:
+        os.close(fd)
+    fields = dict(id_ctrl_fields)
+    fields.update(decode_smart_log(smart_log))
+    for i in range(1, 9):
+        # Like nvme-cli, skip temperature sensors that are not implemented
+        key = f'temperature_sensor_{i}'
+        if fields[key] == 0:
+            del fields[key]
+    return fields
+
+
+def fetch_ns(namespace):
+    """Fetches namespace ID fields for one drive."""
+    fd = os.open('/dev/' + namespace, os.O_RDONLY)
+    try:
+        nsid = fcntl.ioctl(fd, _NVME_IOCTL_ID)
+        id_ns = admin_cmd(fd, _ADMIN_IDENTIFY, nsid, _ID_CNS_NS, _ID_SIZE)
+    finally:
+        os.close(fd)
+    return decode(id_ns, _ID_NS_FIELDS)
+
+
+def process_ns(values, j):
+    """Processes namespace ID for one drive."""
     size, cap, used = map(j.get, ['nsze', 'ncap', 'nuse'])
     emit_df(values, 'free', cap - used)
     emit_df(values, 'used', used)
     emit_df(values, 'reserved', size - cap)
 
 
-def read(_=None):
-    values = collectd.Values(plugin='nvmecli')
+def list_devices():
+    """Returns lists of controllers and namespaces, cached until /dev changes."""
+    global _devices, _devices_mtime
+    # Taken before scanning, so a change during the scan causes another scan next time
+    mtime = os.stat('/dev').st_mtime_ns
+    if _devices is None or mtime != _devices_mtime:
+        devs = []
+        namespaces = []
+        with os.scandir('/dev') as entries:
+            for entry in entries:
+                name = entry.name
+                if not name.startswith('nvme'):
+                    continue
+                matches = _RE_NVME.match(name)
+                if matches is None:
+                    continue
+                if matches.group(1) is None:
+                    devs.append(name)
+                else:
+                    namespaces.append(name)
+        _devices = (devs, namespaces)
+        _devices_mtime = mtime
+        # A drive may have been replaced by another one with the same name
+        _id_ctrl_cache.clear()
+    return _devices
+
+
+def fetch():
+    """Fetches fields for all controllers and namespaces, and returns them with the time."""
+    global _devices
+    devs, namespaces = list_devices()
+    now = time.time()
+    # Drives process admin commands independently (and ioctl releases the GIL), so query all
+    # of them at once. Dispatching is left to this thread.
+    queries = []
+    for func, names in ((fetch_ctrl, devs), (fetch_ns, namespaces)):
+        for name in names:
+            future = _stuck_queries.get(name)
+            if future is None or future.done():
+                _stuck_queries.pop(name, None)
+                future = _EXECUTOR.submit(func, name)
+            else:
+                collectd.warning(f'Skipping {name}, previous query still not finished')
+                future = None
+            queries.append((name, future))
+    wait([future for _, future in queries if future is not None], timeout=_QUERY_TIMEOUT)
+
+    results = {}
+    for name, future in queries:
+        if future is None:
+            continue
+        if not future.done():
+            collectd.warning(f'Timed out querying {name}')
+            _stuck_queries[name] = future
+            continue
+        try:
+            results[name] = future.result()
+        except OSError as err:
+            collectd.error(f'Failed to query {name}: {err}')
+            # A drive may have been removed
+            _devices = None
+    return (now,
+            [(dev, results[dev]) for dev in devs if dev in results],
+            [(namespace, results[namespace]) for namespace in namespaces
+             if namespace in results])
+
+
+def poll():
+    """Polls drives until shutdown, keeping the latest results for read()."""
+    global _data
+    interval = _interval
+    # Schedule against absolute deadlines so that query latency does not accumulate and polls stay
+    # in step with read()
+    t_next_poll = time.monotonic()
+    while True:
+        try:
+            data = fetch()
+        except OSError as err:
+            collectd.error(f'Failed to query drives: {err}')
+            data = None
+        with _data_lock:
+            _data = data
+        t_next_poll += interval
+        t_late = time.monotonic() - t_next_poll
+        if t_late > 0:
+            # The poll took longer than a period, resync instead of bursting catch-up polls
+            t_next_poll += t_late
+        if _stop_polling.wait(max(-t_late, 0.)):
+            # Woken up by shutdown()
+            break
+
+
+def config(config_in):
+    """Parses additional config.
+
+    Config example:
+
+    Import "nvmecli"
+    <Module "nvmecli">
+      Interval 10  # Should match the Interval collectd reads this plugin at
+    </Module>
+    """
+    global _interval
+
+    for node in config_in.children:
+        key = node.key.lower()
+        val = node.values
 
-    redev = re.compile('nvme[0-9]+$')
-    for dev in os.listdir('/dev'):
-        if redev.match(dev):
-            values.plugin_instance = dev
-            process_cmd(values, dev, 'id-ctrl')
-            process_cmd(values, dev, 'smart-log')
+        if key == 'Interval'.lower():
+            assert len(val) == 1 and val[0] > 0
+            _interval = float(val[0])
+        else:
+            collectd.warning('Skipping unknown config key "{}"'.format(key))
 
-    rens = re.compile('nvme[0-9]+n[0-9]+$')
-    for namespace in os.listdir('/dev'):
-        if rens.match(namespace):
-            values.plugin_instance = namespace
-            process_ns(values, namespace)
 
+def init():
+    global _poll_thread
+    _poll_thread = threading.Thread(target=poll, daemon=True)
+    _poll_thread.start()
+    collectd.register_read(read, _interval)
 
-collectd.register_read(read)
+
+def read(_=None):
+    global _data
+    # Take the results so they are not dispatched again if polling stalls
+    with _data_lock:
+        data = _data
+        _data = None
+    if data is None:
+        return
+
+    # All values are stamped once with the time they were polled, rather than by collectd on
+    # each dispatch
+    timestamp, ctrls, namespaces = data
+    values = _VALUES
+    values.time = timestamp
+    for dev, fields in ctrls:
+        values.plugin_instance = dev
+        dispatch_fields(values, fields)
+
+    for namespace, fields in namespaces:
+        values.plugin_instance = namespace
+        process_ns(values, fields)
+
+
+def shutdown():
+    _stop_polling.set()
+    if _poll_thread is not None:
+        _poll_thread.join()
+    # Do not wait for queries stuck on a hung drive
+    _EXECUTOR.shutdown(wait=False)
+
+
+collectd.register_config(config)
+collectd.register_init(init)
+collectd.register_shutdown(shutdown)
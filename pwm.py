@@ -6,43 +6,87 @@ Useful if hardware or software automatic fan speed control is available.
 
 import os
 import re
+from concurrent.futures import ThreadPoolExecutor
 
 import collectd
 
 _SYSFS_PWM_DIR = '/sys/class/hwmon'
+_RE_PWM = re.compile('^pwm[0-9]+$')
 
+_VALUES = collectd.Values(type='fanspeed', plugin='pwm')
 
-def _get_hwmon_name(hwmon):
+# Names do not change while the hwmon device exists, so they are only resolved once
+# {hwmon: (inode of its entry in _SYSFS_PWM_DIR, name)}
+_hwmon_names = {}
+
+# Some hwmon drivers talk to the chip on each attribute read, so devices are read in parallel.
+# Worker threads are only started when needed, and kept across reads.
+_EXECUTOR = ThreadPoolExecutor(max_workers=4)
+
+
+def _get_hwmon_name(hwmon, inode):
     """Returns a stable name for the hwmon device."""
+    cached = _hwmon_names.get(hwmon)
+    # A recreated entry (e.g. the hwmon number was reused by another device) has a new inode
+    if cached is not None and cached[0] == inode:
+        return cached[1]
     with open(f'{_SYSFS_PWM_DIR}/{hwmon}/name') as name_file:
         name = name_file.read().strip()
     device_path = f'{_SYSFS_PWM_DIR}/{hwmon}/device'
     if os.path.islink(device_path):
         name = f'{name}_{os.path.basename(os.readlink(device_path))}'
+    _hwmon_names[hwmon] = (inode, name)
     return name
 
 
+def _read_hwmon(hwmon, inode):
+    """Returns the plugin instance and a list of (PWM name, duty) for the hwmon device."""
+    try:
+        plugin_instance = _get_hwmon_name(hwmon, inode)
+    except OSError as err:
+        collectd.warning(
+            f'Cannot get name of {hwmon}, use raw name instead: {err}')
+        plugin_instance = hwmon
+    with os.scandir(f'{_SYSFS_PWM_DIR}/{hwmon}') as entries:
+        filenames = [entry.name for entry in entries if _RE_PWM.match(entry.name)]
+    duties = []
+    for filename in filenames:
+        try:
+            # sysfs attributes are small, so skip the buffered text file machinery
+            fd = os.open(f'{_SYSFS_PWM_DIR}/{hwmon}/{filename}', os.O_RDONLY)
+            try:
+                duties.append((filename, int(os.read(fd, 16))))
+            finally:
+                os.close(fd)
+        except (OSError, ValueError) as err:
+            collectd.error(err)
+    return plugin_instance, duties
+
+
 def read(_=None):
-    values = collectd.Values(type='fanspeed', plugin='pwm')
-    reobj = re.compile('^pwm[0-9]+$')
+    values = _VALUES
 
-    for hwmon in os.listdir(_SYSFS_PWM_DIR):
-        try:
-            values.plugin_instance = _get_hwmon_name(hwmon)
-        except OSError as err:
-            collectd.warning(
-                f'Cannot get name of {hwmon}, use raw name instead: {err}')
-            values.plugin_instance = hwmon
-        for filename in os.listdir(f'{_SYSFS_PWM_DIR}/{hwmon}'):
-            if reobj.match(filename):
-                try:
-                    with open(f'{_SYSFS_PWM_DIR}/{hwmon}/{filename}'
-                              ) as pwm_file:
-                        # TODO: resolve PWM name by fan*_label
-                        values.dispatch(type_instance=filename,
-                                        values=[int(pwm_file.read())])
-                except (OSError, ValueError) as err:
-                    collectd.error(err)
+    hwmons = []
+    inodes = []
+    with os.scandir(_SYSFS_PWM_DIR) as entries:
+        for entry in entries:
+            hwmons.append(entry.name)
+            # Comes with the directory listing, so this costs no extra syscall
+            inodes.append(entry.inode())
+    for hwmon in set(_hwmon_names) - set(hwmons):
+        del _hwmon_names[hwmon]
+
+    # Dispatching is left to this thread
+    for plugin_instance, duties in _EXECUTOR.map(_read_hwmon, hwmons, inodes):
+        values.plugin_instance = plugin_instance
+        for filename, duty in duties:
+            # TODO: resolve PWM name by fan*_label
+            values.dispatch(type_instance=filename, values=[duty])
+
+
+def shutdown():
+    _EXECUTOR.shutdown(wait=False)
 
 
 collectd.register_read(read)
+collectd.register_shutdown(shutdown)
@@ -1,49 +1,97 @@
-"""Monitors Chia harvesters.
-
-Depends on: pygtail
-"""
+"""Monitors Chia harvesters."""
 
+import math
+import mmap
 import os
 import re
-import tempfile
 
 import collectd
 
-from pygtail.core import Pygtail
-
-_PATTERN_PLOT_INFO = re.compile(
-    r'Loaded a total of ([0-9]+) plots of size ([0-9]+\.[0-9]+) TiB, '
-    r'in ([0-9]+\.[0-9]+) seconds')
-
-# Although we can get a more up-to-date plot count here, we won't be able to
-# update total plot size.
-_PATTERN_PROOF_INFO = re.compile(
-    r'([0-9]+) plots were eligible for farming ([0-9a-f]+)... '
-    r'Found ([0-9]+) proofs. '
-    r'Time: ([0-9]+\.[0-9]+) s. ')
+# Plot info and proof info are matched in a single pass over the log, as alternatives
+# NOTE: the log is matched as bytes, int() and float() accept the groups as they are
+_PATTERN_LOG_INFO = re.compile(
+    rb'Loaded a total of (?P<plot_count>[0-9]+) plots of size '
+    rb'(?P<plot_size>[0-9]+\.[0-9]+) TiB, '
+    rb'in (?P<plot_scan_time>[0-9]+\.[0-9]+) seconds'
+    # Although we can get a more up-to-date plot count here, we won't be able to
+    # update total plot size.
+    rb'|(?P<eligible_plot_count>[0-9]+) plots were eligible for farming '
+    rb'(?P<block>[0-9a-f]+)... '
+    rb'Found (?P<proof_count>[0-9]+) proofs. '
+    rb'Time: (?P<proof_time>[0-9]+\.[0-9]+) s. ')
+
+_VALUES = collectd.Values(plugin='xch', plugin_instance='harvester')
 
 _last_plot_count = 0
 _last_plot_size_tib = 0.
 _last_plot_scan_time = 0.
 _last_plot_scan_time_max = 0.
 
-_last_proof_time = []
+_last_proof_min = math.inf
+_last_proof_max = -math.inf
 
 _log_dir = None
-_log = None
+_log_path = None
+# Position in the log read so far, identified by inode to detect rotation
+_log_inode = None
+_log_offset = 0
 
 
-def _update_last_plot_info(lines):
+def _update_last_plot_info(plot_info_matches):
     global _last_plot_count, _last_plot_size_tib, _last_plot_scan_time, _last_plot_scan_time_max
 
-    for line in lines:
-        plot_info_matches = _PATTERN_PLOT_INFO.search(line)
-        if plot_info_matches:
-            _last_plot_count = int(plot_info_matches.group(1))
-            _last_plot_size_tib = float(plot_info_matches.group(2))
-            _last_plot_scan_time = float(plot_info_matches.group(3))
-            _last_plot_scan_time_max = max(_last_plot_scan_time_max,
-                                           _last_plot_scan_time)
+    _last_plot_count = int(plot_info_matches.group('plot_count'))
+    _last_plot_size_tib = float(plot_info_matches.group('plot_size'))
+    _last_plot_scan_time = float(plot_info_matches.group('plot_scan_time'))
+    _last_plot_scan_time_max = max(_last_plot_scan_time_max,
+                                   _last_plot_scan_time)
+
+
+def _scan_log(path, offset):
+    """Yields matches in complete lines of the file after offset.
+
+    Returns the offset following the last complete line.
+    """
+    with open(path, 'rb') as log_file:
+        if os.fstat(log_file.fileno()).st_size <= offset:
+            return offset
+        # The log is mapped rather than read, so only the matched groups are copied
+        with mmap.mmap(log_file.fileno(), 0, access=mmap.ACCESS_READ) as log_map:
+            # Leave a partially written line for the next read
+            end = log_map.rfind(b'\n', offset) + 1
+            if end == 0:
+                return offset
+            yield from _PATTERN_LOG_INFO.finditer(log_map, offset, end)
+            return end
+
+
+def _read_new_log():
+    """Yields matches in log lines written since the last call.
+
+    Like chia, assumes logs are rotated by renaming debug.log to debug.log.1, in which case the rest
+    of the rotated log is read first.
+    """
+    global _log_inode, _log_offset
+
+    try:
+        stat = os.stat(_log_path)
+    except FileNotFoundError:
+        # In the middle of rotation
+        return
+    if stat.st_ino != _log_inode:
+        if _log_inode is not None:
+            rotated_path = f'{_log_path}.1'
+            try:
+                if os.stat(rotated_path).st_ino == _log_inode:
+                    yield from _scan_log(rotated_path, _log_offset)
+            except FileNotFoundError:
+                pass
+        _log_inode = stat.st_ino
+        _log_offset = 0
+    elif stat.st_size < _log_offset:
+        # Truncated
+        _log_offset = 0
+    _log_offset = yield from _scan_log(_log_path, _log_offset)
 
 
 def config(config_in):
@@ -70,38 +118,56 @@ def config(config_in):
 
 
 def init():
-    """Opens log files for read.
-
-    Pygtail can handle rotated logs (debug.log.[0-9]) from chia.
-    """
-    global _log
+    """Reads the existing log for the last plot info."""
+    global _log_path, _log_inode, _log_offset
 
     if not _log_dir:
         raise RuntimeError('LogDir must be specified')
 
-    log_path = f'{_log_dir}/debug.log'
-    file_desc, offset_path = tempfile.mkstemp(prefix='collectd_xch_harvester',
-                                              suffix='offset')
-    os.close(file_desc)
-    _log = Pygtail(filename=log_path, offset_file=offset_path)
-    _update_last_plot_info(_log.readlines())
+    _log_path = f'{_log_dir}/debug.log'
+    _log_inode = None
+    _log_offset = 0
+    for matches in _read_new_log():
+        if matches.group('plot_count') is not None:
+            _update_last_plot_info(matches)
 
     return True
 
 
 def read(_=None):
-    global _last_plot_scan_time_max, _last_proof_time
+    global _last_plot_scan_time_max, _last_proof_min, _last_proof_max
 
-    values = collectd.Values(plugin='xch', plugin_instance='harvester')
+    values = _VALUES
 
-    lines = _log.readlines()
-    if not lines:
-        # NOTE: this will likely also execute when the plugin starts
-        collectd.warning('pygtail might be stuck, retry init')
-        init()
+    eligible_plot_count = 0
+    blocks = set()
+    proof_count = 0
+    # Proof time statistics are accumulated as the matches are parsed
+    proof_time_count = 0
+    proof_time_sum = 0.
+    proof_time_min = math.inf
+    proof_time_max = -math.inf
+    last_position = (_log_inode, _log_offset)
+    for matches in _read_new_log():
+        if matches.group('plot_count') is not None:
+            _update_last_plot_info(matches)
+            continue
+
+        # The pattern only matches well-formed numbers, so these conversions cannot fail
+        eligible_plots, block, proofs, proof_time = matches.group(
+            'eligible_plot_count', 'block', 'proof_count', 'proof_time')
+        eligible_plot_count += int(eligible_plots)
+        blocks.add(block)
+        proof_count += int(proofs)
+        proof_time = float(proof_time)
+        proof_time_count += 1
+        proof_time_sum += proof_time
+        proof_time_min = min(proof_time_min, proof_time)
+        proof_time_max = max(proof_time_max, proof_time)
+    if (_log_inode, _log_offset) == last_position:
+        # Nothing new was logged
         return
 
-    _update_last_plot_info(lines)
     try:
         values.dispatch(type='gauge',
                         type_instance='Plot',
@@ -122,30 +188,6 @@ def read(_=None):
     except ValueError as err:
         collectd.error(err)
 
-    eligible_plot_count = 0
-    blocks = set()
-    proof_count = 0
-    proof_time = []
-    for line in lines:
-        proof_info_matches = _PATTERN_PROOF_INFO.search(line)
-        if proof_info_matches:
-            try:
-                eligible_plot_count += int(proof_info_matches.group(1))
-            except ValueError as err:
-                collectd.error(err)
-
-            blocks.add(proof_info_matches.group(2))
-
-            try:
-                proof_count += int(proof_info_matches.group(3))
-            except ValueError as err:
-                collectd.error(err)
-
-            try:
-                proof_time.append(float(proof_info_matches.group(4)))
-            except ValueError as err:
-                collectd.error(err)
-
     values.dispatch(type='gauge',
                     type_instance='Eligible plot',
                     values=[eligible_plot_count])
@@ -155,17 +197,18 @@ def read(_=None):
     # NOTE: data may get distorted by RRD interpolation. Max proof duration usually appears somewhat
     # lower than actual due to its spiky nature. To workaround, save min and max proof times and use
     # them twice.
-    if proof_time:
+    if proof_time_count:
         values.dispatch(type='duration',
                         type_instance='Proof average',
-                        values=[sum(proof_time) / len(proof_time)])
+                        values=[proof_time_sum / proof_time_count])
         values.dispatch(type='duration',
                         type_instance='Proof min',
-                        values=[min(proof_time + _last_proof_time)])
+                        values=[min(proof_time_min, _last_proof_min)])
         values.dispatch(type='duration',
                         type_instance='Proof max',
-                        values=[max(proof_time + _last_proof_time)])
-    _last_proof_time = proof_time
+                        values=[max(proof_time_max, _last_proof_max)])
+    _last_proof_min = proof_time_min
+    _last_proof_max = proof_time_max
 
 
 collectd.register_config(config)